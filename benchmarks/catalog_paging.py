@@ -0,0 +1,74 @@
+# Paging through a synthetic games catalog, in-memory GamesDB against
+# LIMIT/OFFSET queries it replaced.
+#
+#   python -m benchmarks.catalog_paging --games 50000
+import argparse
+import asyncio
+import os
+import sqlite3
+import tempfile
+import time
+
+from ifictionbot import session
+
+from .common import make_games_db, report
+
+
+def make_catalog(path, games):
+    make_games_db(path, (('game{:06d}'.format(i), 'Synthetic game number {}'.format(i))
+                         for i in range(games)))
+
+
+def page_with_offset(path, page_size):
+    db = sqlite3.connect(path)
+    count = next(db.execute('SELECT count(*) FROM games'))[0]
+    times = []
+    for offset in range(0, count, page_size):
+        start = time.perf_counter()
+        db.execute('SELECT * FROM games LIMIT ? OFFSET ?', (page_size, offset)).fetchall()
+        times.append(time.perf_counter() - start)
+    db.close()
+    return times
+
+
+async def page_with_games_db(loop, path, page_size):
+    games_db = session.GamesDB(loop, path, path + '.fts')
+    start = time.perf_counter()
+    iterator = await games_db.list_games(0, page_size)
+    print('initial load: {:.2f}ms'.format((time.perf_counter() - start) * 1000))
+
+    times = []
+    while iterator.ways_to_iterate()[1]:
+        start = time.perf_counter()
+        await iterator.next()
+        times.append(time.perf_counter() - start)
+
+    lookups = []
+    for i in range(0, len(times), 7):
+        start = time.perf_counter()
+        await games_db.get_game('game{:06d}'.format(i))
+        lookups.append(time.perf_counter() - start)
+
+    games_db.close()
+    return times, lookups
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--games', type=int, default=50000)
+    parser.add_argument('--page-size', type=int, default=3)
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(prefix='catalog-'), 'ifarchive.db')
+    make_catalog(path, args.games)
+
+    report('LIMIT/OFFSET page', page_with_offset(path, args.page_size))
+
+    loop = asyncio.get_event_loop()
+    pages, lookups = loop.run_until_complete(page_with_games_db(loop, path, args.page_size))
+    report('GamesDB page', pages)
+    report('GamesDB lookup', lookups)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+# Full-text search latency over a synthetic games catalog.
+#
+#   python -m benchmarks.catalog_search --games 5000
+#   python -m benchmarks.catalog_search --games 50000  # size of the search latency target
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+
+from ifictionbot import session
+
+from .common import make_games_db, report
+
+SYLLABLES = 'ka lo mi ne ru sa te vo an el is or um dra gon cas tle for est'.split()
+
+
+def make_words(count):
+    rnd = random.Random(2)
+    return sorted({''.join(rnd.choice(SYLLABLES) for _ in range(rnd.randint(2, 4)))
+                   for _ in range(count)})
+
+
+WORDS = make_words(5000)
+
+
+def make_catalog(path, games):
+    rnd = random.Random(0)
+    make_games_db(path, (('{}{}'.format(rnd.choice(WORDS), i),
+                          ' '.join(rnd.choice(WORDS) for _ in range(8))) for i in range(games)))
+
+
+async def run(loop, path, queries):
+    games_db = session.GamesDB(loop, path, path + '.fts')
+    start = time.perf_counter()
+    await games_db.list_games(0, 3)
+    print('load: {:.2f}ms'.format((time.perf_counter() - start) * 1000))
+    scan_start = time.perf_counter()
+    iterator = await games_db.search_games(WORDS[0][:3], 3)
+    print('search while indexing: {:.2f}ms, {} games on the first page'.format(
+        (time.perf_counter() - scan_start) * 1000, len(await iterator.get_page())))
+    await games_db.indexed()
+    print('load and index: {:.2f}ms'.format((time.perf_counter() - start) * 1000))
+
+    rnd = random.Random(1)
+    times = []
+    for _ in range(queries):
+        text = ' '.join(rnd.choice(WORDS)[:rnd.randint(3, 8)] for _ in range(rnd.randint(1, 2)))
+        start = time.perf_counter()
+        iterator = await games_db.search_games(text, 3)
+        await iterator.get_page()
+        times.append(time.perf_counter() - start)
+
+    games_db.close()
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--games', type=int, default=5000)
+    parser.add_argument('--queries', type=int, default=500)
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(prefix='catalog-'), 'ifarchive.db')
+    make_catalog(path, args.games)
+
+    loop = asyncio.get_event_loop()
+    report('search', loop.run_until_complete(run(loop, path, args.queries)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+import os
+import sqlite3
+import sys
+import tempfile
+
+FAKE_FROB = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fake_frob.py')
+
+
+def install_fake_frob(**options):
+    # puts fake "frob" executable first in PATH, returns its directory
+    bin_path = tempfile.mkdtemp(prefix='fake-frob-')
+    frob_path = os.path.join(bin_path, 'frob')
+    with open(frob_path, 'w') as f:
+        f.write('#!/bin/sh\nexec {} {} "$@"\n'.format(sys.executable, FAKE_FROB))
+    os.chmod(frob_path, 0o755)
+
+    os.environ['PATH'] = bin_path + os.pathsep + os.environ['PATH']
+    for key, value in options.items():
+        os.environ['FAKE_FROB_' + key.upper()] = str(value)
+    return bin_path
+
+
+def make_games_db(path, games):
+    # creates games catalog at path from (name, description) pairs
+    db = sqlite3.connect(path)
+    db.execute('CREATE TABLE games (name TEXT, desc TEXT)')
+    db.executemany('INSERT INTO games VALUES (?, ?)', games)
+    db.commit()
+    db.close()
+
+
+def make_data_path(prefix, games, game_files=False):
+    # creates bot data path with games catalog and, optionally, empty game files
+    data_path = tempfile.mkdtemp(prefix=prefix)
+    os.makedirs(data_path + '/games')
+    games = list(games)
+    make_games_db(data_path + '/games/ifarchive.db', games)
+    if game_files:
+        for name, _ in games:
+            open('{}/games/{}.gam'.format(data_path, name), 'w').close()
+    return data_path
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return float('nan')
+    k = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+    return values[k]
+
+
+def report(name, seconds):
+    print('{}: n={} p50={:.3f}ms p99={:.3f}ms max={:.3f}ms'.format(
+        name, len(seconds), percentile(seconds, 50) * 1000,
+        percentile(seconds, 99) * 1000, max(seconds) * 1000))
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# Stand-in for 'frob -iplain <game>.gam' used by benchmarks.
+#
+# Behaviour is tuned with environment variables:
+#   FAKE_FROB_PARAGRAPHS  paragraphs printed per command (default 3)
+#   FAKE_FROB_LINES       lines per paragraph (default 3)
+#   FAKE_FROB_DELAY       seconds to think before answering (default 0)
+#   FAKE_FROB_PAUSE       seconds to pause after the first paragraph of an answer (default 0)
+#   FAKE_FROB_NO_PROMPT   don't print '>' prompt, like old interpreters
+import os
+import sys
+import time
+
+PARAGRAPHS = int(os.environ.get('FAKE_FROB_PARAGRAPHS', 3))
+LINES = int(os.environ.get('FAKE_FROB_LINES', 3))
+DELAY = float(os.environ.get('FAKE_FROB_DELAY', 0))
+PAUSE = float(os.environ.get('FAKE_FROB_PAUSE', 0))
+PROMPT = '' if os.environ.get('FAKE_FROB_NO_PROMPT') else '>'
+
+
+def write(text):
+    sys.stdout.write(text)
+    sys.stdout.flush()
+
+
+def answer(cmd):
+    paragraphs = []
+    for p in range(PARAGRAPHS):
+        lines = ['{} line {} of paragraph {}.'.format(cmd.capitalize(), l, p)
+                 for l in range(LINES)]
+        paragraphs.append('\n'.join(lines) + '\n')
+    if PAUSE and len(paragraphs) > 1:
+        write('\n' + paragraphs[0])
+        time.sleep(PAUSE)
+        write('\n' + '\n'.join(paragraphs[1:]) + '\n' + PROMPT)
+    else:
+        write('\n' + '\n'.join(paragraphs) + '\n' + PROMPT)
+
+
+def main():
+    game = sys.argv[-1]
+    game_dir = os.path.dirname(os.path.abspath(game))
+    write('Fake frob interpreter\n\n')
+    answer('intro')
+    for line in sys.stdin:
+        cmd = line.strip()
+        if cmd in ('save', 'restore'):
+            name = sys.stdin.readline().strip()
+            if cmd == 'save':
+                open(os.path.join(game_dir, name + '.sav'), 'w').close()
+            write('\nOk.\n\n' + PROMPT)
+            continue
+        elif cmd == 'restart':
+            # adv.t asks on the same line, the answer is the next command
+            write('\nAre you sure you want to start over? (YES or NO) > ')
+            continue
+        elif cmd in ('quit', 'q'):
+            break
+
+        if DELAY:
+            time.sleep(DELAY)
+        answer(cmd)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+# Latency from Frob.command() to the first sendMessage of the turn.
+#
+#   python -m benchmarks.frob_latency --turns 200
+#   python -m benchmarks.frob_latency --no-prompt  # idle timeout fallback
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+from ifictionbot import session
+
+from .common import install_fake_frob, report
+
+
+class TimingSender:
+    def __init__(self):
+        self.messages = 0
+        self.first_message_time = None
+        self.turn_done = asyncio.Event()
+        self.expected = 0
+
+    async def sendMessage(self, msg, **kwargs):
+        if self.first_message_time is None:
+            self.first_message_time = time.perf_counter()
+        self.messages += 1
+        if self.messages >= self.expected:
+            self.turn_done.set()
+
+
+async def run(args):
+    game_path = tempfile.mkdtemp(prefix='frob-latency-')
+    open(os.path.join(game_path, 'bench.gam'), 'w').close()
+
+    sender = TimingSender()
+    frob = session.Frob('bench', sender, args.idle_timeout)
+    sender.expected = args.paragraphs  # intro banner paragraph is skipped
+    await frob.start(game_path, 'bench')
+    read_loop = asyncio.ensure_future(frob.read_loop())
+    await sender.turn_done.wait()
+
+    latencies = []
+    for i in range(args.turns):
+        sender.messages = 0
+        sender.expected = args.paragraphs
+        sender.first_message_time = None
+        sender.turn_done.clear()
+
+        start = time.perf_counter()
+        await frob.command('look')
+        await sender.turn_done.wait()
+        latencies.append(sender.first_message_time - start)
+
+    read_loop.cancel()
+    frob._process.kill()
+    report('command to sendMessage', latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--turns', type=int, default=100)
+    parser.add_argument('--paragraphs', type=int, default=3)
+    parser.add_argument('--idle-timeout', type=float, default=session.Frob._DEFAULT_IDLE_TIMEOUT)
+    parser.add_argument('--no-prompt', action='store_true')
+    args = parser.parse_args()
+
+    options = {'paragraphs': args.paragraphs}
+    if args.no_prompt:
+        options['no_prompt'] = 1
+    install_fake_frob(**options)
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(run(args))
+
+
+if __name__ == '__main__':
+    main()
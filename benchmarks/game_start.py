@@ -0,0 +1,79 @@
+# Game directory setup overhead per game start: shell based setup the bot
+# used before against Workspaces, cold (first start) and warm (restarts).
+#
+#   python -m benchmarks.game_start --users 200 --rounds 5
+import argparse
+import asyncio
+import os
+import time
+
+from ifictionbot import workspaces
+
+from .common import make_data_path, report
+
+
+def init_user_dir(data_path, user_id):
+    # previous setup, run on every session and game start
+    user_path = os.path.abspath('{}/users/{}'.format(data_path, user_id))
+    if not os.path.exists(user_path):
+        os.makedirs(user_path)
+
+
+def init_game_dir(data_path, user_id, game):
+    source_game_path = os.path.abspath('{}/games/{}.gam'.format(data_path, game))
+    game_data_path = os.path.abspath('{}/users/{}/{}'.format(data_path, user_id, game))
+    if not os.path.exists(game_data_path):
+        os.makedirs(game_data_path)
+    game_path = '{}/{}.gam'.format(game_data_path, game)
+    os.system('ln -sf {} {}'.format(source_game_path, game_path))
+    return game_data_path
+
+
+def shell_starts(users, games, rounds):
+    data_path = make_data_path('game-start-', [(g, g) for g in games], game_files=True)
+    times = []
+    for _ in range(rounds):
+        for user_id in range(users):
+            for game in games:
+                start = time.perf_counter()
+                init_user_dir(data_path, user_id)
+                init_game_dir(data_path, user_id, game)
+                times.append(time.perf_counter() - start)
+    return times
+
+
+async def workspace_starts(loop, users, games, rounds, prepare):
+    data_path = make_data_path('game-start-', [(g, g) for g in games], game_files=True)
+    game_workspaces = workspaces.Workspaces(loop, data_path)
+    if prepare:
+        await game_workspaces.prepare([(u, g) for u in range(users) for g in games])
+    times = []
+    for _ in range(rounds):
+        for user_id in range(users):
+            for game in games:
+                start = time.perf_counter()
+                await game_workspaces.game_dir(user_id, game)
+                times.append(time.perf_counter() - start)
+    game_workspaces.close()
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--games', type=int, default=2)
+    parser.add_argument('--rounds', type=int, default=5)
+    args = parser.parse_args()
+
+    games = ['game{}'.format(i) for i in range(args.games)]
+    report('shell', shell_starts(args.users, games, args.rounds))
+
+    loop = asyncio.get_event_loop()
+    report('workspaces', loop.run_until_complete(
+        workspace_starts(loop, args.users, games, 1, False)))
+    report('workspaces, cached', loop.run_until_complete(
+        workspace_starts(loop, args.users, games, args.rounds, True)))
+
+
+if __name__ == '__main__':
+    main()
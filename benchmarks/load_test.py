@@ -0,0 +1,302 @@
+# Load test of the whole bot: the real DelegatorBot and Session stack polls
+# a local stand-in of the Bot API, interpreters are benchmarks/fake_frob.py.
+# Simulated players open the menu, browse the catalog, start a game, send
+# commands and return to the menu. Step latency is the time from posting an
+# update to the first reply that belongs to it. Results are saved as JSON,
+# --baseline compares them with a previous run.
+#
+#   python -m benchmarks.load_test --chats 1000 --commands 10 --output load.json
+#   python -m benchmarks.load_test --chats 1000 --baseline load.json
+#
+# RSS and fd counts are of this process, which runs the bot and the
+# simulated players, plus the resident memory of the interpreters.
+import argparse
+import asyncio
+import collections
+import json
+import os
+import random
+import sys
+import time
+import urllib.parse
+
+import telepot.aio.api
+
+from ifictionbot import __main__ as bot_main
+
+from .common import install_fake_frob, make_data_path, percentile
+
+TOKEN = '123:load-test'
+GAMES = 50
+
+
+class FakeTelegram:
+    # answers getUpdates from pushed updates and collects sendMessage calls
+    def __init__(self):
+        self._updates = collections.deque()
+        self._update_id = 0
+        self._message_id = 0
+        self._new_updates = asyncio.Event()
+        self._waiters = {}  # chat id: (expected text, future)
+        self.requests = collections.Counter()
+
+    async def start(self, port):
+        self._server = await asyncio.start_server(self._serve, '127.0.0.1', port)
+
+    def close(self):
+        self._server.close()
+
+    def make_update(self, chat_id, text):
+        self._update_id += 1
+        self._message_id += 1
+        return {'update_id': self._update_id, 'message': {
+            'message_id': self._message_id, 'date': int(time.time()), 'text': text,
+            'from': {'id': chat_id, 'is_bot': False, 'first_name': 'Player'},
+            'chat': {'id': chat_id, 'type': 'private', 'first_name': 'Player'}}}
+
+    async def step(self, chat_id, text, expected, timeout, deliver=None):
+        # seconds until a message containing expected is sent to the chat,
+        # the update is served by getUpdates unless deliver takes it
+        future = asyncio.get_event_loop().create_future()
+        self._waiters[chat_id] = (expected, future)
+        update = self.make_update(chat_id, text)
+        if deliver:
+            deliver(update)
+        else:
+            self._updates.append(update)
+            self._new_updates.set()
+        start = time.perf_counter()
+        try:
+            await asyncio.wait_for(future, timeout)
+        finally:
+            self._waiters.pop(chat_id, None)
+        return time.perf_counter() - start
+
+    async def _serve(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                length = 0
+                while True:
+                    header = await reader.readline()
+                    if header in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = header.decode('latin-1').partition(':')
+                    if name.strip().lower() == 'content-length':
+                        length = int(value)
+                body = await reader.readexactly(length)
+                method = request_line.split()[1].decode('latin-1').rsplit('/', 1)[1]
+                params = {k: v[0] for k, v in
+                          urllib.parse.parse_qs(body.decode('utf-8')).items()}
+                result = json.dumps({'ok': True, 'result': await self._call(method, params)})
+                result = result.encode('utf-8')
+                writer.write('HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n'
+                             'Content-Length: {}\r\n\r\n'.format(len(result))
+                             .encode('latin-1') + result)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass  # cancelled when the bot is stopped
+        finally:
+            writer.close()
+
+    async def _call(self, method, params):
+        self.requests[method] += 1
+        if method == 'getUpdates':
+            return await self._get_updates(int(params.get('offset', 0)),
+                                           float(params.get('timeout', 0)))
+        elif method == 'sendMessage':
+            return self._send_message(int(params['chat_id']), params['text'])
+        elif method == 'getMe':
+            return {'id': 123, 'is_bot': True, 'first_name': 'ifictionbot'}
+        return True
+
+    async def _get_updates(self, offset, timeout):
+        while self._updates and self._updates[0]['update_id'] < offset:
+            self._updates.popleft()
+        if not self._updates and timeout:
+            self._new_updates.clear()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return list(self._updates)[:100]
+
+    def _send_message(self, chat_id, text):
+        expected, future = self._waiters.get(chat_id, (None, None))
+        if future and not future.done() and expected in text:
+            future.set_result(None)
+        self._message_id += 1
+        return {'message_id': self._message_id, 'date': int(time.time()), 'text': text,
+                'chat': {'id': chat_id, 'type': 'private'}}
+
+
+def use_fake_api(port):
+    telepot.aio.api._methodurl = lambda req, **user_kw: 'http://127.0.0.1:{}/bot{}/{}'.format(
+        port, req[0], req[1])
+
+
+def make_load_test_data():
+    return make_data_path('load-test-', (('game{:04d}'.format(i), 'Load test game {}'.format(i))
+                                         for i in range(GAMES)), game_files=True)
+
+
+async def player(api, chat_id, args, latencies, errors):
+    rnd = random.Random(chat_id)
+    steps = [('start', '/start', 'Choose section'),
+             ('browse', 'Games database', '/game'),
+             ('page', 'Forward ➡️', '/game'),
+             ('game', '/game game{:04d}'.format(rnd.randrange(GAMES)), 'Intro line')]
+    steps += [('command', 'go{}'.format(i), 'Go{} line'.format(i))
+              for i in range(args.commands)]
+    steps.append(('menu', 'Return to the main menu', 'Choose section'))
+
+    await asyncio.sleep(rnd.uniform(0, args.ramp))
+    for name, text, expected in steps:
+        try:
+            latency = await api.step(chat_id, text, expected, args.timeout)
+        except asyncio.TimeoutError:
+            errors[name] += 1
+        else:
+            latencies[name].append(latency)  # no empty list for a step never answered
+        await asyncio.sleep(rnd.uniform(0, 2 * args.think_time))
+
+
+def process_stats():
+    with open('/proc/self/statm') as f:
+        rss = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    return rss, len(os.listdir('/proc/self/fd'))
+
+
+async def sample(providers, peaks):
+    while True:
+        rss, fds = process_stats()
+        frob_rss = providers['frob_pool'].stats()['rss']
+        peaks['rss'] = max(peaks['rss'], rss)
+        peaks['fds'] = max(peaks['fds'], fds)
+        peaks['frob_rss'] = max(peaks['frob_rss'], frob_rss)
+        await asyncio.sleep(1)
+
+
+async def run(loop, args, port):
+    api = FakeTelegram()
+    await api.start(port)
+    use_fake_api(port)
+
+    sys.argv = ['ifictionbot', TOKEN, make_load_test_data(),
+                '--send-rate', '100000', '--chat-send-rate', str(args.chat_send_rate)]
+    sys.argv += args.bot_arg
+    shutdown, providers = bot_main.start_bot(bot_main.parse_args(), loop)
+
+    latencies = collections.defaultdict(list)
+    errors = collections.Counter()
+    peaks = {'rss': 0, 'fds': 0, 'frob_rss': 0}
+    sampler = loop.create_task(sample(providers, peaks))
+    start = time.perf_counter()
+    await asyncio.gather(*[player(api, 1000 + n, args, latencies, errors)
+                           for n in range(args.chats)])
+    duration = time.perf_counter() - start
+    sampler.cancel()
+
+    await shutdown()
+    api.close()
+
+    steps = sum(len(values) for values in latencies.values())
+    return {
+        'config': {'chats': args.chats, 'commands': args.commands, 'ramp': args.ramp,
+                   'think_time': args.think_time, 'paragraphs': args.paragraphs,
+                   'frob_delay': args.frob_delay, 'bot_args': args.bot_arg},
+        'duration': duration,
+        'throughput': steps / duration,
+        'errors': dict(errors),
+        'steps': {name: {'n': len(values),
+                         'p50': percentile(values, 50),
+                         'p90': percentile(values, 90),
+                         'p99': percentile(values, 99),
+                         'max': max(values)}
+                  for name, values in sorted(latencies.items())},
+        'peak_rss': peaks['rss'],
+        'peak_frob_rss': peaks['frob_rss'],
+        'peak_fds': peaks['fds'],
+        'requests': dict(api.requests),
+    }
+
+
+def print_result(result):
+    print('{} chats, {:.1f}s, {:.1f} steps/s, errors {}'.format(
+        result['config']['chats'], result['duration'], result['throughput'],
+        result['errors'] or 'none'))
+    for name, step in result['steps'].items():
+        print('{}: n={} p50={:.1f}ms p90={:.1f}ms p99={:.1f}ms max={:.1f}ms'.format(
+            name, step['n'], step['p50'] * 1000, step['p90'] * 1000, step['p99'] * 1000,
+            step['max'] * 1000))
+    print('peak rss {:.1f}MB, interpreters {:.1f}MB, fds {}'.format(
+        result['peak_rss'] / 2**20, result['peak_frob_rss'] / 2**20, result['peak_fds']))
+
+
+def compare(result, baseline, tolerance):
+    # returns the number of values worse than baseline by more than tolerance
+    regressions = 0
+
+    def check(name, value, base, higher_is_better=False):
+        nonlocal regressions
+        if not base:
+            return
+        change = (value - base) / base
+        worse = -change if higher_is_better else change
+        mark = ''
+        if worse > tolerance:
+            mark = '  REGRESSION'
+            regressions += 1
+        print('{}: {:.4g} -> {:.4g} ({:+.1f}%){}'.format(name, base, value, change * 100, mark))
+
+    check('throughput', result['throughput'], baseline['throughput'], higher_is_better=True)
+    for name, step in result['steps'].items():
+        base = baseline['steps'].get(name)
+        if base:
+            check(name + ' p50', step['p50'], base['p50'])
+            check(name + ' p99', step['p99'], base['p99'])
+    check('peak rss', result['peak_rss'], baseline['peak_rss'])
+    check('peak fds', result['peak_fds'], baseline['peak_fds'])
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--chats', type=int, default=200)
+    parser.add_argument('--commands', type=int, default=5)
+    parser.add_argument('--ramp', type=float, default=10,
+                        help='seconds over which players arrive')
+    parser.add_argument('--think-time', type=float, default=1,
+                        help='average seconds between steps of a player')
+    parser.add_argument('--timeout', type=float, default=60)
+    parser.add_argument('--paragraphs', type=int, default=3)
+    parser.add_argument('--frob-delay', type=float, default=0)
+    parser.add_argument('--chat-send-rate', type=float, default=1000,
+                        help='per chat send rate of the bot, the real limit hides latency')
+    parser.add_argument('--bot-arg', action='append', default=[],
+                        help='extra bot argument as --bot-arg=--max-starts=8, may be repeated')
+    parser.add_argument('--port', type=int, default=18443)
+    parser.add_argument('--output', help='save results as JSON')
+    parser.add_argument('--baseline', help='compare with results saved before')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='relative change reported as regression')
+    args = parser.parse_args()
+
+    install_fake_frob(paragraphs=args.paragraphs, delay=args.frob_delay)
+    loop = asyncio.get_event_loop()
+    result = loop.run_until_complete(run(loop, args, args.port))
+    print_result(result)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            if compare(result, json.load(f), args.tolerance):
+                sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+# Interpreter output parsing: the line based parser Frob used before against
+# the streaming OutputParser fed with random chunk boundaries. The output is
+# checked by tests/test_output_parser.py.
+#
+#   python -m benchmarks.output_parser --paragraphs 200
+import argparse
+import random
+import time
+
+from ifictionbot import session
+
+from .common import report
+
+WORDS = ['lamp', 'door', 'Кубок', 'north', 'café', 'the', 'You', 'see', 'a', '>', ' ', '—']
+
+
+def get_lines_delimiter(start, end):
+    # previous parser, applied to the whole turn split into lines
+    if not start:
+        return ''
+
+    if end[0].isupper() or end[0] == ' ':
+        return '\n'
+    else:
+        return ' '
+
+
+def split_lines(output):
+    lines = [l + b'\n' for l in output.split(b'\n')]
+    tail = lines.pop()
+    if tail != b'\n':
+        lines.append(tail)
+    return lines
+
+
+def parse_lines(blines):
+    lines = [l.decode('utf-8') for l in blines]
+    msgs = []
+    last_msg = ''
+    for b in lines:
+        if b:
+            if b[0] == '>':
+                b = b[1:]
+
+            if b == '\n':
+                if last_msg.strip():
+                    msgs.append(last_msg)
+                last_msg = ''
+            else:
+                last_msg += get_lines_delimiter(last_msg, b)
+                last_msg += b[:-1]
+
+    if last_msg.strip():
+        msgs.append(last_msg)
+
+    return msgs
+
+
+def make_screen(rnd, paragraphs, lines):
+    text = []
+    for _ in range(paragraphs):
+        for _ in range(rnd.randint(1, lines)):
+            text.append(' '.join(rnd.choice(WORDS) for _ in range(rnd.randint(1, 12))))
+        text.append(rnd.choice(['', '', ' ', '>']))
+    return '\n'.join(text).encode('utf-8')
+
+
+def chunks(rnd, output, count):
+    cuts = sorted(rnd.randint(0, len(output)) for _ in range(count))
+    return [output[a:b] for a, b in zip([0] + cuts, cuts + [len(output)])]
+
+
+def parse_streaming(parts):
+    parser = session.OutputParser()
+    paragraphs = []
+    for part in parts:
+        paragraphs += parser.feed(part)
+    return paragraphs + parser.finish()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--screens', type=int, default=200)
+    parser.add_argument('--paragraphs', type=int, default=200)
+    parser.add_argument('--lines', type=int, default=8)
+    parser.add_argument('--chunks', type=int, default=16)
+    args = parser.parse_args()
+
+    rnd = random.Random(1)
+    screens = [make_screen(rnd, args.paragraphs, args.lines) for _ in range(args.screens)]
+    print('{} screens, {:.0f}KB each'.format(
+        len(screens), sum(map(len, screens)) / len(screens) / 1024))
+
+    times = []
+    for screen in screens:
+        start = time.perf_counter()
+        parse_lines(split_lines(screen))
+        times.append(time.perf_counter() - start)
+    report('line parser', times)
+
+    times = []
+    for screen in screens:
+        parts = chunks(rnd, screen, args.chunks)
+        start = time.perf_counter()
+        parse_streaming(parts)
+        times.append(time.perf_counter() - start)
+    report('streaming parser', times)
+
+
+if __name__ == '__main__':
+    main()
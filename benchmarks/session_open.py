@@ -0,0 +1,102 @@
+# Session open path: constructs Session for chats back to back and runs
+# open() with the first message, as DelegatorBot does for a new chat, then
+# closes it. Returning users are in the main menu, the catalog or the last
+# played list, the game dialog is left out because it starts an
+# interpreter. Logging is disabled. Exits with 1 when p99 of open is above
+# the budget.
+#
+#   python -m benchmarks.session_open --chats 5000 --budget-ms 1
+import argparse
+import asyncio
+import logging
+import sys
+import time
+
+import telepot.aio
+
+from ifictionbot import session
+from ifictionbot import snapshots
+from ifictionbot import transcripts
+from ifictionbot import users
+from ifictionbot import workspaces
+
+from .common import make_data_path, report
+
+DIALOGS = [session.DIALOG_MAIN, session.DIALOG_BROWSING, session.DIALOG_LAST_PLAYED]
+
+
+class NullSender:
+    async def sendMessage(self, *args, **kwargs):
+        pass
+
+
+class NullSendQueue:
+    def sender(self, chat_id, sender):
+        return NullSender()
+
+
+def message(chat_id, text):
+    return {'message_id': 1, 'date': int(time.time()), 'text': text,
+            'from': {'id': chat_id, 'is_bot': False, 'first_name': 'Player'},
+            'chat': {'id': chat_id, 'type': 'private', 'first_name': 'Player'}}
+
+
+async def run(loop, args):
+    data_path = make_data_path(
+        'session-open-', (('game{:05d}'.format(i), 'Game number {}'.format(i))
+                          for i in range(args.games)))
+    user_store = users.UserStore(loop, data_path + '/users.db')
+    for chat_id in range(args.chats // 2):  # half of chats are returning users
+        state = dict(session.Session._DEFAULT_STATE, current=DIALOGS[chat_id % len(DIALOGS)])
+        state[session.DIALOG_LAST_PLAYED] = {'games': ['game{:05d}'.format(chat_id % 10)]}
+        user_store.save(chat_id, state)
+    await user_store.flush()
+
+    games_db = session.GamesDB(loop, data_path + '/games/ifarchive.db',
+                               data_path + '/ifarchive.fts.db')
+    await games_db.list_games(0, 3)  # catalog is loaded once per process
+    game_snapshots = snapshots.Snapshots(loop, data_path)
+    game_snapshots.start()
+    services = (workspaces.Workspaces(loop, data_path), game_snapshots,
+                transcripts.Transcripts(loop, data_path), loop, session.SessionRegistry(),
+                user_store, games_db, session.RenderCache(), 3,
+                session.FrobPool(loop, data_path), session.Hibernator(loop), NullSendQueue())
+    bot = telepot.aio.DelegatorBot('123:session-open', [], loop)  # as the bot seeds sessions
+
+    opens = []
+    closes = []
+    for chat_id in range(args.chats):
+        msg = message(chat_id, '/start' if chat_id % 3 else 'hello')
+        start = time.perf_counter()
+        s = session.Session((bot, msg, chat_id), *services, event_space=0, timeout=20 * 60)
+        await s.open(msg, None)
+        opens.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await s.close()
+        closes.append(time.perf_counter() - start)
+
+    report('open', opens)
+    report('close', closes)
+    await user_store.close()
+    games_db.close()
+    return sorted(opens)[int(len(opens) * 0.99)]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--chats', type=int, default=5000)
+    parser.add_argument('--games', type=int, default=5000)
+    parser.add_argument('--budget-ms', type=float, default=1)
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    loop = asyncio.get_event_loop()
+    p99 = loop.run_until_complete(run(loop, args))
+    if p99 * 1000 > args.budget_ms:
+        print('open p99 {:.3f}ms is above the {}ms budget'.format(p99 * 1000, args.budget_ms))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
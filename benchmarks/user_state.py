@@ -0,0 +1,74 @@
+# Session open/close throughput of user state storage: per-user shelve
+# files the bot used before against the shared UserStore.
+#
+#   python -m benchmarks.user_state --users 1000
+import argparse
+import asyncio
+import os
+import shelve
+import tempfile
+import time
+
+from ifictionbot import session
+from ifictionbot import users
+
+STATE = session.Session._DEFAULT_STATE
+
+
+class ShelveUserDB:
+    # previous UserDB implementation
+    def __init__(self, data_path, user_id, init_state):
+        self._db = shelve.open('{}/users/{}/user.shlv'.format(data_path, user_id))
+        for key, value in init_state.items():
+            if key not in self._db:
+                self._db[key] = value
+        self._db.sync()
+
+    def current_state(self):
+        return dict(self._db)
+
+    def save_state(self, state):
+        for key, value in state.items():
+            self._db[key] = value
+        self._db.sync()
+
+    def close(self):
+        self._db.close()
+
+
+def open_close(make_db, users, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for user_id in range(users):
+            db = make_db(user_id)
+            state = db.current_state()
+            state['current'] = session.DIALOG_BROWSING
+            db.save_state(state)
+            db.close()
+    return users * rounds / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--rounds', type=int, default=3)
+    args = parser.parse_args()
+
+    data_path = tempfile.mkdtemp(prefix='user-state-')
+    for user_id in range(args.users):
+        os.makedirs('{}/users/{}'.format(data_path, user_id))
+
+    rate = open_close(lambda u: ShelveUserDB(data_path, u, STATE), args.users, args.rounds)
+    print('shelve: {:.0f} sessions/s'.format(rate))
+
+    loop = asyncio.get_event_loop()
+    store = users.UserStore(loop, data_path + '/users.db')
+    rate = open_close(lambda u: users.UserDB(store, u, STATE), args.users, args.rounds)
+    start = time.perf_counter()
+    loop.run_until_complete(store.close())
+    print('user store: {:.0f} sessions/s, final flush {:.2f}ms'.format(
+        rate, (time.perf_counter() - start) * 1000))
+
+
+if __name__ == '__main__':
+    main()
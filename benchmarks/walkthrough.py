@@ -0,0 +1,136 @@
+# Scripted walkthrough through Frob: commands sent one per message, each
+# after the answer to the previous one, against messages of --batch
+# commands pipelined by Frob.pipeline(). Reports turns per second and the
+# number of messages sent to the chat. Every mode also checks that the
+# recorded turns are the commands sent, each with its own answer, and exits
+# with 1 otherwise; one command per message without waiting for answers is
+# checked as well. Every tenth command is 'restart', answered with a yes or
+# no question on the same line as its '>'.
+#
+#   python -m benchmarks.walkthrough --turns 500 --batch 10
+#   python -m benchmarks.walkthrough --frob-delay 0.01  # interpreter think time
+#   python -m benchmarks.walkthrough --turns 20 --frob-delay 0.15  # above the idle timeout
+#   python -m benchmarks.walkthrough --turns 20 --frob-pause 0.3  # pause in the middle of answers
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+from ifictionbot import session
+
+from .common import install_fake_frob
+
+QUESTION = 'Are you sure you want to start over? (YES or NO) >'
+ANSWER_TIMEOUT = 30  # turns not answered in time are mismatched
+
+
+class CountingSender:
+    def __init__(self):
+        self.messages = 0
+        self.expected = 0
+        self.done = asyncio.Event()
+
+    async def sendMessage(self, msg, **kwargs):
+        self.messages += 1
+        if self.messages >= self.expected:
+            self.done.set()
+
+    async def wait(self, messages):
+        self.expected += messages
+        if self.messages < self.expected:
+            self.done.clear()
+            await asyncio.wait_for(self.done.wait(), ANSWER_TIMEOUT)
+
+
+def answer_messages(cmd, paragraphs_per_answer):
+    return 1 if cmd == 'restart' else paragraphs_per_answer
+
+
+def check_turns(commands, turns, paragraphs_per_answer):
+    # returns the number of turns not matching the commands sent, every
+    # paragraph of a turn must be a part of the answer to its command
+    mismatches = abs(len(commands) - len(turns))
+    for cmd, (recorded, paragraphs) in zip(commands, turns):
+        if cmd == 'restart':
+            matched = [p.strip() for p in paragraphs] == [QUESTION]
+        else:
+            own = cmd.capitalize() + ' line '
+            matched = (len(paragraphs) == paragraphs_per_answer
+                       and all(p.startswith(own) for p in paragraphs))
+        if recorded != cmd or not matched:
+            mismatches += 1
+    return mismatches
+
+
+async def walkthrough(args, batch, wait=True):
+    # seconds, messages sent and mismatched turns for args.turns turns
+    game_path = tempfile.mkdtemp(prefix='walkthrough-')
+    open(os.path.join(game_path, 'bench.gam'), 'w').close()
+
+    sender = CountingSender()
+    frob = session.Frob('bench', sender)
+    await frob.start(game_path, 'bench')
+    read_loop = asyncio.ensure_future(frob.read_loop())
+    await sender.wait(args.paragraphs)  # intro banner paragraph is skipped
+
+    turns = []
+
+    async def on_turn(cmd, paragraphs):
+        turns.append((cmd, paragraphs))
+
+    frob.record_turns(on_turn)
+    commands = ['restart' if i % 10 == 9 else 'go{}'.format(i) for i in range(args.turns)]
+    sender.messages = sender.expected = 0
+    start = time.perf_counter()
+    try:
+        for i in range(0, len(commands), batch):
+            if batch == 1:
+                await frob.command(commands[i])
+                if wait:
+                    await sender.wait(answer_messages(commands[i], args.paragraphs))
+            else:
+                await frob.pipeline(commands[i:i + batch])
+                await sender.wait(1)  # one message for the pipeline
+        if not wait:
+            await sender.wait(sum(answer_messages(cmd, args.paragraphs) for cmd in commands))
+    except asyncio.TimeoutError:
+        print('no answer in {} seconds'.format(ANSWER_TIMEOUT))
+    elapsed = time.perf_counter() - start
+
+    read_loop.cancel()
+    frob.kill()
+    return elapsed, sender.messages, check_turns(commands, turns, args.paragraphs)
+
+
+async def run(args):
+    failed = False
+    for name, batch, wait in (
+            ('one command per message', 1, True),
+            ('one command per message, not waiting for answers', 1, False),
+            ('{} commands per message'.format(args.batch), args.batch, True)):
+        elapsed, messages, mismatches = await walkthrough(args, batch, wait)
+        print('{}: {} turns in {:.2f}s, {:.1f} turns/s, {} messages, {} turns mismatched'.format(
+            name, args.turns, elapsed, args.turns / elapsed, messages, mismatches))
+        failed = failed or mismatches
+    return not failed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--turns', type=int, default=200)
+    parser.add_argument('--batch', type=int, default=session.GameDialog._MAX_COMMANDS)
+    parser.add_argument('--paragraphs', type=int, default=3)
+    parser.add_argument('--frob-delay', type=float, default=0)
+    parser.add_argument('--frob-pause', type=float, default=0)
+    args = parser.parse_args()
+
+    install_fake_frob(paragraphs=args.paragraphs, delay=args.frob_delay, pause=args.frob_pause)
+    loop = asyncio.get_event_loop()
+    if not loop.run_until_complete(run(args)):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
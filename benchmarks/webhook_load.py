@@ -0,0 +1,153 @@
+# Update to reply latency of the bot with --webhook against long polling.
+# The whole bot runs as __main__ starts it, with start_webhook feeding
+# start_bot, and talks to the local stand-in of the Bot API of load_test.
+# Clients post updates to the webhook, each one a menu request answered by
+# the bot, and wait for the reply before the next one; in polling mode the
+# same updates are served by getUpdates.
+#
+#   python -m benchmarks.webhook_load --clients 50 --requests 20
+import argparse
+import asyncio
+import json
+import socket
+import sys
+import time
+
+from ifictionbot import __main__ as bot_main
+from ifictionbot import webhook
+
+from .common import report
+from .load_test import TOKEN, FakeTelegram, make_load_test_data, use_fake_api
+
+SECRET = 'benchmark-secret'
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class WebhookClient:
+    # one keep-alive connection posting updates to the webhook
+    def __init__(self, port):
+        self._port = port
+        self.statuses = []
+
+    async def connect(self):
+        self._reader, self._writer = await asyncio.open_connection('127.0.0.1', self._port)
+        self._responses = asyncio.ensure_future(self._read_responses())
+
+    def post(self, update):
+        body = json.dumps(update).encode('utf-8')
+        self._writer.write('POST /webhook HTTP/1.1\r\nHost: localhost\r\n'
+                           'Content-Type: application/json\r\nContent-Length: {}\r\n'
+                           '{}: {}\r\n\r\n'.format(len(body), webhook.SECRET_HEADER, SECRET)
+                           .encode('latin-1') + body)
+
+    async def _read_responses(self):
+        while True:
+            status_line = await self._reader.readline()
+            if not status_line:
+                return
+            length = 0
+            while True:
+                header = await self._reader.readline()
+                if header in (b'\r\n', b''):
+                    break
+                name, _, value = header.decode('latin-1').partition(':')
+                if name.strip().lower() == 'content-length':
+                    length = int(value)
+            await self._reader.readexactly(length)
+            self.statuses.append(int(status_line.split()[1]))
+
+    def close(self):
+        self._responses.cancel()
+        self._writer.close()
+
+
+async def player(api, chat_id, args, port, latencies, errors, statuses):
+    client = None
+    if port:
+        client = WebhookClient(port)
+        await client.connect()
+    for _ in range(args.requests):
+        try:
+            latencies.append(await api.step(chat_id, '/start', 'Choose section', args.timeout,
+                                            client.post if client else None))
+        except asyncio.TimeoutError:
+            errors.append(chat_id)
+    if client:
+        statuses += client.statuses
+        client.close()
+
+
+async def measure(api, args, port, shutdown):
+    latencies = []
+    errors = []
+    statuses = []
+    start = time.perf_counter()
+    await asyncio.gather(*[player(api, 1000 + n, args, port, latencies, errors, statuses)
+                           for n in range(args.clients)])
+    elapsed = time.perf_counter() - start
+    await shutdown()
+    return latencies, elapsed, len(errors), sum(1 for s in statuses if s != 200)
+
+
+def run_mode(loop, api, args, webhook_port):
+    # the bot is started as __main__ starts it in this mode
+    sys.argv = ['ifictionbot', TOKEN, make_load_test_data(),
+                '--send-rate', '100000', '--chat-send-rate', '100000']
+    if webhook_port:
+        sys.argv += ['--webhook', '127.0.0.1:{}'.format(webhook_port),
+                     '--webhook-secret', SECRET, '--webhook-path', '/webhook']
+    bot_args = bot_main.parse_args()
+
+    if webhook_port:
+        updates = asyncio.Queue()
+        server = bot_main.start_webhook(bot_args, loop, updates.put_nowait)
+        stop_bot, _ = bot_main.start_bot(bot_args, loop, updates)
+
+        async def shutdown():
+            server.close()
+            await stop_bot()
+    else:
+        shutdown, _ = bot_main.start_bot(bot_args, loop)
+
+    result = loop.run_until_complete(measure(api, args, webhook_port, shutdown))
+    # sessions of the stopped bot
+    tasks = asyncio.all_tasks(loop)
+    for task in tasks:
+        task.cancel()
+    loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clients', type=int, default=50)
+    parser.add_argument('--requests', type=int, default=20)
+    parser.add_argument('--timeout', type=float, default=20)
+    args = parser.parse_args()
+
+    loop = asyncio.get_event_loop()
+    api = FakeTelegram()
+    api_port = free_port()
+    loop.run_until_complete(api.start(api_port))
+    use_fake_api(api_port)
+
+    failed = False
+    for name, webhook_port in (('webhook', free_port()), ('long polling', None)):
+        latencies, elapsed, errors, rejected = run_mode(loop, api, args, webhook_port)
+        print('{}: {} updates in {:.2f}s: {:.0f} updates/s, no reply: {}, '
+              'non-200 responses: {}'.format(name, len(latencies), elapsed,
+                                             len(latencies) / elapsed, errors, rejected))
+        report('{} update to reply'.format(name), latencies)
+        failed = failed or errors or rejected
+    api.close()
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+# Smoke test of worker processes: starts --workers worker processes the way
+# Supervisor does, writes several updates per shard to their stdin and
+# waits for the answers on a local stand-in of the Bot API. Exits with 1
+# when an update is not answered.
+#
+#   python -m benchmarks.workers_smoke --workers 2 --chats 8
+import argparse
+import asyncio
+import json
+import sys
+
+from ifictionbot import __main__ as bot_main
+from ifictionbot import shard
+
+from .load_test import TOKEN, FakeTelegram, make_load_test_data, use_fake_api
+
+STEPS = [('/start', 'Choose section'),
+         ('Games database', '/game'),
+         ('Return to the main menu', 'Choose section')]
+
+
+def run_worker(port, argv):
+    # worker process entry, the bot talks to the fake API
+    use_fake_api(port)
+    sys.argv = ['ifictionbot'] + argv
+    bot_main.main()
+
+
+async def start_worker(args, data_path, number):
+    return await asyncio.create_subprocess_exec(
+        sys.executable, '-m', 'benchmarks.workers_smoke', '--worker', str(args.port),
+        TOKEN, data_path, '--workers', str(args.workers), '--shard', str(number),
+        '--log-level', 'WARNING',
+        stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.DEVNULL)
+
+
+async def player(api, workers, chat_id, args, failures):
+    worker = workers[shard.shard_of(chat_id, len(workers))]
+
+    def deliver(update):
+        worker.stdin.write(json.dumps(update).encode('utf-8') + b'\n')
+
+    for text, expected in STEPS:
+        try:
+            await api.step(chat_id, text, expected, args.timeout, deliver)
+        except asyncio.TimeoutError:
+            print('chat {}: no answer to {!r}'.format(chat_id, text))
+            failures.append(chat_id)
+            return
+
+
+async def run(args):
+    api = FakeTelegram()
+    await api.start(args.port)
+    data_path = make_load_test_data()
+    workers = [await start_worker(args, data_path, n) for n in range(args.workers)]
+
+    failures = []
+    await asyncio.gather(*[player(api, workers, 100 + n, args, failures)
+                           for n in range(args.chats)])
+
+    for worker in workers:
+        worker.stdin.close()  # the worker shuts down when its updates end
+    await asyncio.wait([asyncio.ensure_future(w.wait()) for w in workers],
+                       timeout=args.timeout)
+    for worker in workers:
+        if worker.returncode is None:
+            worker.kill()
+    api.close()
+
+    updates = args.chats * len(STEPS)
+    print('{} workers, {} updates, {} chats failed'.format(
+        args.workers, updates, len(failures)))
+    return not failures
+
+
+def main():
+    if sys.argv[1:2] == ['--worker']:
+        run_worker(int(sys.argv[2]), sys.argv[3:])
+        return
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--chats', type=int, default=8)
+    parser.add_argument('--timeout', type=float, default=20)
+    parser.add_argument('--port', type=int, default=18444)
+    args = parser.parse_args()
+
+    loop = asyncio.get_event_loop()
+    if not loop.run_until_complete(run(args)):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
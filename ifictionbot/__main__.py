@@ -1,4 +1,5 @@
 from concurrent.futures import CancelledError
+import argparse
 import asyncio
 import logging
 import signal
@@ -7,43 +8,312 @@ import sys
 from telepot.aio.delegate import create_open, pave_event_space, per_chat_id
 import telepot
 
+from . import logs
+from . import metrics
+from . import sandbox
+from . import sendqueue
 from . import session
+from . import shard
+from . import snapshots
+from . import transcripts
+from . import users
+from . import watchdog
+from . import webhook
+from . import workspaces
 
-if __name__ == "__main__":
-    token = sys.argv[1]
-    data_path = sys.argv[2]
-    print('data path: ' + data_path)
 
-    formatter = logging.Formatter('%(asctime)s | %(levelname)s | %(message)s')
+def parse_args():
+    parser = argparse.ArgumentParser(prog='ifictionbot')
+    parser.add_argument('token', help='telegram bot token')
+    parser.add_argument('data_path', help='directory with games and users data')
+    parser.add_argument('--frob-idle-timeout', type=float,
+                        default=session.Frob._DEFAULT_IDLE_TIMEOUT,
+                        help='seconds to wait for interpreter output when no prompt is printed')
+    parser.add_argument('--frob-pool', metavar='GAME=SIZE', action='append', default=[],
+                        help='keep SIZE started interpreters of GAME ready, may be repeated')
+    parser.add_argument('--frob-memory-limit', type=int, default=512,
+                        help='megabytes of address space of an interpreter, 0 means no limit')
+    parser.add_argument('--frob-cpu-limit', type=int, default=3600,
+                        help='cpu seconds of an interpreter, 0 means no limit')
+    parser.add_argument('--frob-nice', type=int, default=5,
+                        help='nice increment of interpreters')
+    parser.add_argument('--frob-cgroup', metavar='PATH',
+                        help='writable cgroup v2 directory for interpreter processes')
+    parser.add_argument('--memory-budget', type=int, default=0,
+                        help='megabytes of resident memory of all interpreters, new games '
+                             'wait or are rejected above it, 0 means no limit')
+    parser.add_argument('--memory-budget-wait', type=float,
+                        default=session.FrobPool._DEFAULT_BUDGET_WAIT,
+                        help='seconds a new game waits for memory before it is rejected')
+    parser.add_argument('--max-starts', type=int, default=4,
+                        help='interpreters starting at once, other games wait in line, '
+                             '0 means no limit')
+    parser.add_argument('--hibernate-after', type=float, default=5 * 60,
+                        help='seconds without commands before a game is saved and '
+                             'its interpreter stopped, 0 disables hibernation')
+    parser.add_argument('--max-live-frobs', type=int, default=0,
+                        help='hibernate least recently used games above this number '
+                             'of running interpreters, 0 means no limit')
+    parser.add_argument('--games-db-workers', type=int, default=2,
+                        help='threads running games database queries')
+    parser.add_argument('--games-db-mmap', type=int, default=0,
+                        help='bytes of games database to memory map, 0 disables mmap')
+    parser.add_argument('--page-size', type=int, default=3,
+                        help='games on a page of the catalog and search results')
+    parser.add_argument('--render-cache-size', type=int,
+                        default=session.RenderCache._DEFAULT_SIZE,
+                        help='rendered catalog texts kept in memory')
+    parser.add_argument('--state-flush-interval', type=float,
+                        default=users.UserStore._DEFAULT_FLUSH_INTERVAL,
+                        help='seconds between writes of changed user states')
+    parser.add_argument('--prepare-workspaces', type=int, default=1000,
+                        help='prepare game directories of this number of last users at start')
+    parser.add_argument('--snapshot-keep', type=int, default=snapshots.Snapshots._DEFAULT_KEEP,
+                        help='saved versions kept for every user game')
+    parser.add_argument('--snapshot-quota', type=int, default=0,
+                        help='megabytes of saved games, older versions are removed above it, '
+                             'divided between workers, 0 means no limit')
+    parser.add_argument('--transcript-flush-interval', type=float,
+                        default=transcripts.Transcripts._DEFAULT_FLUSH_INTERVAL,
+                        help='seconds between writes of played turns to the transcript log')
+    parser.add_argument('--send-rate', type=float, default=sendqueue.SendQueue._DEFAULT_RATE,
+                        help='messages per second sent to all chats')
+    parser.add_argument('--chat-send-rate', type=float,
+                        default=sendqueue.SendQueue._DEFAULT_CHAT_RATE,
+                        help='messages per second sent to one chat')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='run sessions in this number of worker processes')
+    parser.add_argument('--shard', type=int, help=argparse.SUPPRESS)  # worker process number
+    parser.add_argument('--webhook', metavar='HOST:PORT',
+                        help='receive updates through webhook on this address '
+                             'instead of long polling')
+    parser.add_argument('--webhook-path', default='/webhook',
+                        help='URL path of the webhook')
+    parser.add_argument('--webhook-secret',
+                        help='secret token passed to setWebhook, required with --webhook')
+    parser.add_argument('--metrics', metavar='HOST:PORT',
+                        help='serve prometheus metrics on this address, worker '
+                             'processes use the following ports')
+    parser.add_argument('--stall-threshold', type=float, default=0.25,
+                        help='log the stack of event loop stalls longer than this '
+                             'number of seconds, 0 disables the watchdog')
+    parser.add_argument('--profile-dir',
+                        help='directory for profiles toggled by SIGUSR1, data path by default')
+    parser.add_argument('--log-level', default='DEBUG',
+                        help='log level, optionally followed by levels of modules, '
+                             'for example INFO,session=DEBUG,sendqueue=WARNING')
+    parser.add_argument('--log-queue', action='store_true',
+                        help='format and write log records in a background thread')
+    parser.add_argument('--frob-trace-rate', type=float, default=1.0,
+                        help='share of interpreter turns with output logged at debug level')
+    parser.add_argument('--shutdown-timeout', type=float, default=10,
+                        help='seconds to save all games on SIGINT')
+    args = parser.parse_args()
+    if args.webhook and not args.webhook_secret:
+        parser.error('--webhook requires --webhook-secret')
+    try:
+        logs.parse_levels(args.log_level)
+        parse_pool_sizes(args.frob_pool)
+    except ValueError as e:
+        parser.error(e)
+    return args
 
-    stream_logger = logging.StreamHandler()
-    stream_logger.setFormatter(formatter)
-    stream_logger.setLevel(logging.DEBUG)
 
-    logging.basicConfig(level=logging.DEBUG, handlers=[stream_logger])
+def parse_pool_sizes(specs):
+    # ['zork1=2'] -> {'zork1': 2}
+    sizes = {}
+    for spec in specs:
+        game, _, size = spec.rpartition('=')
+        if not game or not size.isdigit():
+            raise ValueError('--frob-pool expects GAME=SIZE, got {}'.format(spec))
+        sizes[game] = int(size)
+    return sizes
+
+
+def recent_games(args, user_store):
+    games = []
+    for user_id, state in user_store.recent(args.prepare_workspaces):
+        if args.shard is not None and shard.shard_of(user_id, args.workers) != args.shard:
+            continue
+        game = state.get(session.DIALOG_GAME, {}).get('game')
+        if game:
+            games.append((user_id, game))
+    return games
+
+
+def start_bot(args, loop, source=None):
+    data_path = args.data_path
+    send_rate = args.send_rate
+    if args.workers:
+        send_rate /= args.workers
 
-    loop = asyncio.get_event_loop()
     registry = session.SessionRegistry()
+    user_store = users.UserStore(loop, data_path + '/users.db', args.state_flush_interval)
+    user_store.start()
+    game_workspaces = workspaces.Workspaces(loop, data_path)
+    loop.create_task(game_workspaces.prepare(recent_games(args, user_store)))
+    game_snapshots = snapshots.Snapshots(
+        loop, data_path, max(1, args.snapshot_keep),
+        args.snapshot_quota * 1024 * 1024 // max(1, args.workers), args.shard, args.workers)
+    game_snapshots.start()
+    game_transcripts = transcripts.Transcripts(loop, data_path, args.transcript_flush_interval)
+    game_transcripts.start()
+    games_db = session.GamesDB(loop, data_path + '/games/ifarchive.db',
+                               data_path + '/ifarchive.fts.db',
+                               args.games_db_workers, args.games_db_mmap)
+    limits = sandbox.ResourceLimits(args.frob_memory_limit * 1024 * 1024, args.frob_cpu_limit,
+                                    args.frob_nice, args.frob_cgroup)
+    render_cache = session.RenderCache(args.render_cache_size)
+    frob_pool = session.FrobPool(
+        loop, data_path, args.frob_idle_timeout, parse_pool_sizes(args.frob_pool), limits,
+        args.memory_budget * 1024 * 1024 // max(1, args.workers), args.memory_budget_wait,
+        args.max_starts)
+    frob_pool.start()
+    hibernator = session.Hibernator(loop, args.hibernate_after, args.max_live_frobs)
+    send_queue = sendqueue.SendQueue(loop, send_rate, args.chat_send_rate)
     bot = telepot.aio.DelegatorBot(
-        token,
+        args.token,
         [pave_event_space()(
-            per_chat_id(), create_open, session.Session, data_path, loop,
-            registry, timeout=20 * 60)],
+            per_chat_id(), create_open, session.Session, game_workspaces, game_snapshots,
+            game_transcripts, loop, registry, user_store, games_db, render_cache, args.page_size,
+            frob_pool, hibernator, send_queue, timeout=20 * 60)],
         loop
     )
-    loop.create_task(bot.message_loop())
+    if source is None:
+        message_loop = loop.create_task(
+            shard.poll_updates(bot, lambda update: shard.handle_update(bot, update)))
+    else:
+        message_loop = loop.create_task(shard.handle_updates(bot, source))
 
-    def sigint_handler():
-        logging.info('SIGINT')
+    async def shutdown():
+        message_loop.cancel()
+        await registry.close_all(args.shutdown_timeout)
+        await send_queue.close(args.shutdown_timeout)
+        await user_store.close()
+        frob_pool.close()
+        games_db.close()
+        game_workspaces.close()
+        game_snapshots.close()
+        await game_transcripts.close()
+
+    stats_providers = {'registry': registry, 'frob_pool': frob_pool, 'hibernator': hibernator,
+                       'games_db': games_db, 'user_store': user_store, 'send_queue': send_queue,
+                       'workspaces': game_workspaces, 'snapshots': game_snapshots,
+                       'transcripts': game_transcripts, 'render_cache': render_cache}
+    return shutdown, stats_providers
+
+
+def start_webhook(args, loop, handler):
+    server = webhook.WebhookServer(handler, args.webhook_path, args.webhook_secret)
+    loop.run_until_complete(server.start(*webhook.parse_address(args.webhook)))
+    return server
+
+
+def start_supervisor(args, loop):
+    worker_argv = sys.argv[1:]
+    supervisor = shard.Supervisor(loop, telepot.aio.Bot(args.token, loop), worker_argv,
+                                  args.workers)
+    server = None
+    if args.webhook:
+        server = start_webhook(args, loop, supervisor.dispatch)
+    supervisor.start(poll=server is None)
+
+    async def shutdown():
+        if server:
+            server.close()
+        await supervisor.close(args.shutdown_timeout)
+
+    return shutdown, supervisor
+
+
+def start_metrics(args, loop, collector):
+    host, port = webhook.parse_address(args.metrics)
+    if args.shard is not None:
+        port += args.shard + 1
+    metrics.add_collector(collector)
+    server = metrics.MetricsServer()
+    loop.run_until_complete(server.start(host, port))
+    loop.create_task(metrics.monitor_loop_lag())
+    return server
+
+
+def main():
+    args = parse_args()
+
+    formatter = logging.Formatter('%(asctime)s | %(levelname)s | %(message)s')
+    if args.shard is not None:
+        formatter = logging.Formatter(
+            '%(asctime)s | shard {} | %(levelname)s | %(message)s'.format(args.shard))
+
+    stop_logging = logs.setup(args.log_level, formatter, args.log_queue)
+    session.FROB_TRACES.set_rate(args.frob_trace_rate)
+    logging.info('data path: ' + args.data_path)
+
+    loop = asyncio.get_event_loop()
+    collector = None
+    if args.shard is not None:
+        updates = asyncio.Queue()
+        stop_bot, stats_providers = start_bot(args, loop, updates)
+        loop.create_task(shard.report_stats(stats_providers, 10))
+        collector = metrics.stats_collector(stats_providers)
+    elif args.workers:
+        stop_bot, supervisor = start_supervisor(args, loop)
+        collector = supervisor.collect
+    elif args.webhook:
+        updates = asyncio.Queue()
+        server = start_webhook(args, loop, updates.put_nowait)
+        stop_webhook_bot, stats_providers = start_bot(args, loop, updates)
+        collector = metrics.stats_collector(dict(stats_providers, webhook=server))
+
+        async def stop_bot():
+            server.close()
+            await stop_webhook_bot()
+    else:
+        stop_bot, stats_providers = start_bot(args, loop)
+        collector = metrics.stats_collector(stats_providers)
+
+    if args.stall_threshold:
+        stall_watchdog = watchdog.StallWatchdog(loop, args.stall_threshold)
+        stall_watchdog.start()
+        metrics.add_collector(metrics.stats_collector({'watchdog': stall_watchdog}))
+
+    if args.metrics:
+        start_metrics(args, loop, collector)
+
+    profiler = watchdog.SamplingProfiler()
+    loop.add_signal_handler(signal.SIGUSR1, profiler.toggle,
+                            args.profile_dir or args.data_path)
+
+    update_reader = None  # stdin reader is weakly referenced, the task is kept here
+    stopping = False
+
+    async def shutdown():
+        nonlocal stopping
+        if stopping:
+            return
+        stopping = True
+        if update_reader:
+            update_reader.cancel()
         try:
-            registry.close_all()
+            await stop_bot()
         except Exception as e:
             logging.error(e)
         finally:
             loop.stop()
 
+    def sigint_handler():
+        logging.info('SIGINT')
+        loop.create_task(shutdown())
+
     loop.add_signal_handler(signal.SIGINT, sigint_handler)
 
+    if args.shard is not None:
+        async def read_updates():
+            await shard.read_updates(loop, updates)
+            loop.create_task(shutdown())  # the worker stops when its updates end
+
+        update_reader = loop.create_task(read_updates())
+
     logging.info('Listening ...')
     try:
         loop.run_forever()
@@ -52,5 +322,14 @@ if __name__ == "__main__":
     else:
         logging.info('Completed')
     finally:
+        # sessions and background loops left after shutdown end before the loop closes
+        tasks = asyncio.all_tasks(loop)
+        for task in tasks:
+            task.cancel()
+        loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
         loop.close()
+        stop_logging()
 
+
+if __name__ == "__main__":
+    main()
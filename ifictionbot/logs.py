@@ -0,0 +1,64 @@
+import logging
+import logging.handlers
+import queue
+
+
+def parse_levels(spec):
+    # 'INFO,session=DEBUG' -> default level and levels of modules
+    default = logging.DEBUG
+    levels = {}
+    for item in spec.split(','):
+        module, _, level = item.strip().rpartition('=')
+        level = logging.getLevelName(level.upper())
+        if not isinstance(level, int):
+            raise ValueError('unknown log level in {}'.format(item))
+        if module:
+            levels[module] = level
+        else:
+            default = level
+    return default, levels
+
+
+def setup(spec, formatter, use_queue=False):
+    # returns function flushing and stopping the log writer
+    default, levels = parse_levels(spec)
+    handler = logging.StreamHandler()
+    handler.setFormatter(formatter)
+
+    # records below the level of their module logger are never made
+    root = logging.getLogger()
+    root.setLevel(default)
+    for module, level in levels.items():
+        logging.getLogger(__package__ + '.' + module).setLevel(level)
+    if not use_queue:
+        root.addHandler(handler)
+        return lambda: None
+
+    # the loop only fills messages in and enqueues records, a thread formats
+    # and writes them
+    records = queue.SimpleQueue()
+    root.addHandler(logging.handlers.QueueHandler(records))
+    listener = logging.handlers.QueueListener(records, handler)
+    listener.start()
+    return listener.stop
+
+
+class Sampler:
+    # lets through the given share of calls while debug logging of logger is
+    # enabled
+    def __init__(self, logger, rate=1.0):
+        self._logger = logger
+        self._rate = rate
+        self._credit = 0.0
+
+    def set_rate(self, rate):
+        self._rate = rate
+
+    def sample(self):
+        if not self._logger.isEnabledFor(logging.DEBUG):
+            return False
+        self._credit += self._rate
+        if self._credit < 1:
+            return False
+        self._credit -= 1
+        return True
@@ -0,0 +1,151 @@
+import asyncio
+import logging
+import threading
+import time
+
+_logger = logging.getLogger(__name__)
+info, error = _logger.info, _logger.error
+
+_metrics = []
+_collectors = []
+
+DEFAULT_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                          for k, v in sorted(labels.items())) + '}'
+
+
+class Counter:
+    def __init__(self, name, help_):
+        self._name = name
+        self._help = help_
+        self._values = {}
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self._name, self._help),
+                 '# TYPE {} counter'.format(self._name)]
+        with self._lock:
+            for key, value in self._values.items():
+                lines.append('{}{} {}'.format(self._name, _format_labels(dict(key)), value))
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_, buckets=DEFAULT_BUCKETS):
+        self._name = name
+        self._help = help_
+        self._buckets = buckets
+        self._counts = [0] * len(buckets)
+        self._count = 0
+        self._sum = 0.0
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def observe(self, value):
+        with self._lock:
+            self._count += 1
+            self._sum += value
+            for i, bound in enumerate(self._buckets):
+                if value <= bound:
+                    self._counts[i] += 1
+                    break
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self._name, self._help),
+                 '# TYPE {} histogram'.format(self._name)]
+        with self._lock:
+            total = 0
+            for bound, count in zip(self._buckets, self._counts):
+                total += count
+                lines.append('{}_bucket{{le="{}"}} {}'.format(self._name, bound, total))
+            lines.append('{}_bucket{{le="+Inf"}} {}'.format(self._name, self._count))
+            lines.append('{}_sum {}'.format(self._name, self._sum))
+            lines.append('{}_count {}'.format(self._name, self._count))
+        return lines
+
+
+def add_collector(collector):
+    # collector returns (name, value, labels) tuples exported as gauges
+    _collectors.append(collector)
+
+
+def stats_collector(providers, prefix='ifictionbot'):
+    # export numeric values of stats() dicts, nested dicts become labeled values
+    def collect():
+        for provider_name, provider in providers.items():
+            for key, value in provider.stats().items():
+                name = '{}_{}_{}'.format(prefix, provider_name, key)
+                if isinstance(value, dict):
+                    for label, item in value.items():
+                        yield name, item, {'key': label}
+                elif isinstance(value, (int, float)):
+                    yield name, value, {}
+    return collect
+
+
+def render():
+    lines = []
+    for metric in _metrics:
+        lines += metric.render()
+
+    typed = set()
+    for collector in _collectors:
+        try:
+            for name, value, labels in collector():
+                if name not in typed:
+                    lines.append('# TYPE {} gauge'.format(name))
+                    typed.add(name)
+                lines.append('{}{} {}'.format(name, _format_labels(labels), value))
+        except Exception as e:
+            error('metrics: collector error %s', e)
+    return '\n'.join(lines) + '\n'
+
+
+LOOP_LAG = Histogram('ifictionbot_event_loop_lag_seconds',
+                     'Delay of event loop wakeups over the expected time')
+
+
+async def monitor_loop_lag(interval=0.5):
+    while True:
+        start = time.monotonic()
+        await asyncio.sleep(interval)
+        LOOP_LAG.observe(max(0.0, time.monotonic() - start - interval))
+
+
+class MetricsServer:
+    # serves render() in prometheus text format on any GET request
+    def __init__(self):
+        self._server = None
+
+    async def start(self, host, port):
+        self._server = await asyncio.start_server(self._serve, host, port)
+        info('metrics: listening on %s:%s', host, port)
+
+    def close(self):
+        if self._server:
+            self._server.close()
+
+    async def _serve(self, reader, writer):
+        try:
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass  # request line and headers are not interesting
+            body = render().encode('utf-8')
+            writer.write('HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n'
+                         'Content-Length: {}\r\nConnection: close\r\n\r\n'
+                         .format(len(body)).encode('latin-1') + body)
+            await writer.drain()
+        except ConnectionError as e:
+            error('metrics: connection error %s', e)
+        finally:
+            writer.close()
@@ -0,0 +1,52 @@
+import argparse
+import asyncio
+import glob
+import os
+import shelve
+
+from . import users
+
+
+def find_user_shelves(data_path):
+    # dbm backends add their own suffixes to the shelve file name
+    for path in sorted(glob.glob('{}/users/*/user.shlv*'.format(data_path))):
+        user_path = os.path.dirname(path)
+        yield os.path.basename(user_path), os.path.join(user_path, 'user.shlv')
+
+
+async def migrate(loop, data_path, overwrite):
+    store = users.UserStore(loop, data_path + '/users.db')
+    migrated = skipped = 0
+    seen = set()
+    for user_id, path in find_user_shelves(data_path):
+        if user_id in seen:
+            continue
+        seen.add(user_id)
+
+        if store.load(user_id) and not overwrite:
+            skipped += 1
+            continue
+
+        with shelve.open(path, 'r') as db:
+            store.save(user_id, dict(db))
+        migrated += 1
+
+    await store.close()
+    print('migrated: {}, skipped: {}'.format(migrated, skipped))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='ifictionbot.migrate_users',
+        description='import users/*/user.shlv states into users.db')
+    parser.add_argument('data_path', help='directory with games and users data')
+    parser.add_argument('--overwrite', action='store_true',
+                        help='replace states already present in users.db')
+    args = parser.parse_args()
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(migrate(loop, args.data_path, args.overwrite))
+
+
+if __name__ == '__main__':
+    main()
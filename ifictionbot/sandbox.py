@@ -0,0 +1,59 @@
+import logging
+import os
+import resource
+
+_logger = logging.getLogger(__name__)
+info, error = _logger.info, _logger.error
+
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+_CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+
+
+class ResourceLimits:
+    # limits applied to interpreter processes by the bot right after spawn,
+    # memory in bytes and cpu in seconds, 0 means no limit
+    def __init__(self, memory=0, cpu_time=0, nice=0, cgroup=None):
+        self._memory = memory
+        self._cpu_time = cpu_time
+        self._nice = nice
+        self._cgroup_procs = None
+        if cgroup:
+            self._cgroup_procs = self._init_cgroup(cgroup)
+
+    @staticmethod
+    def _init_cgroup(path):
+        # cgroup v2 directory delegated to the bot user
+        procs = os.path.join(path, 'cgroup.procs')
+        if not os.access(procs, os.W_OK):
+            error('sandbox: cgroup %s is not writable, not used', path)
+            return None
+        info('sandbox: interpreters are placed in cgroup %s', path)
+        return procs
+
+    def apply(self, pid):
+        # nothing runs between fork and exec, the bot has threads
+        try:
+            if self._memory:
+                resource.prlimit(pid, resource.RLIMIT_AS, (self._memory, self._memory))
+            if self._cpu_time:
+                resource.prlimit(pid, resource.RLIMIT_CPU, (self._cpu_time, self._cpu_time + 1))
+            if self._nice:
+                os.setpriority(os.PRIO_PROCESS, pid,
+                               os.getpriority(os.PRIO_PROCESS, 0) + self._nice)
+            if self._cgroup_procs:
+                with open(self._cgroup_procs, 'w') as f:
+                    f.write(str(pid))
+        except OSError as e:
+            error('sandbox: limits of process %s not set: %s', pid, e)
+
+
+def process_usage(pid):
+    # resident memory in bytes and cpu time in seconds
+    try:
+        with open('/proc/{}/stat'.format(pid)) as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+    except (OSError, IndexError):
+        return 0, 0.0
+    # fields start from the third stat field, state
+    cpu_time = (int(fields[11]) + int(fields[12])) / _CLOCK_TICKS
+    return int(fields[21]) * _PAGE_SIZE, cpu_time
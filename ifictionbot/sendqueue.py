@@ -0,0 +1,170 @@
+import asyncio
+import collections
+import logging
+import time
+
+import telepot.exception
+
+from . import metrics
+
+_logger = logging.getLogger(__name__)
+debug, error, warning = _logger.debug, _logger.error, _logger.warning
+
+MESSAGE_LIMIT = 4096
+
+SEND_TIME = metrics.Histogram('ifictionbot_send_message_seconds', 'Telegram sendMessage time')
+SEND_ERRORS = metrics.Counter('ifictionbot_send_message_errors_total',
+                              'Failed Telegram sendMessage calls')
+
+
+def split_message(text, limit=MESSAGE_LIMIT):
+    parts = []
+    while len(text) > limit:
+        cut = text.rfind('\n', 0, limit)
+        if cut <= 0:
+            cut = text.rfind(' ', 0, limit)
+        if cut <= 0:
+            cut = limit
+        parts.append(text[:cut])
+        text = text[cut:].lstrip('\n ')
+    parts.append(text)
+    return parts
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self._rate = rate
+        self._capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self._rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self._rate)
+
+
+class ChatQueue:
+    def __init__(self, sender, rate, capacity):
+        self.sender = sender
+        self.messages = collections.deque()
+        self.bucket = TokenBucket(rate, capacity)
+
+
+class SendQueue:
+    # per chat FIFO of outgoing messages, consecutive messages with the same
+    # options are merged, sends are limited by per chat and global rates
+    _DEFAULT_RATE = 30
+    _DEFAULT_CHAT_RATE = 1
+    _CHAT_BURST = 3
+    _MAX_RETRIES = 5
+
+    def __init__(self, loop, rate=_DEFAULT_RATE, chat_rate=_DEFAULT_CHAT_RATE):
+        self._loop = loop
+        self._chat_rate = chat_rate
+        self._bucket = TokenBucket(rate, rate)
+        self._chats = {}
+        self._tasks = {}
+        self._queued = 0
+        self._sent = 0
+        self._merged = 0
+        self._retries = 0
+        self._errors = 0
+        self._send_time = 0.0
+
+    def sender(self, chat_id, sender):
+        return QueuedSender(self, chat_id, sender)
+
+    def put(self, chat_id, sender, text, options):
+        chat = self._chats.get(chat_id)
+        if not chat:
+            chat = self._chats[chat_id] = ChatQueue(sender, self._chat_rate, self._CHAT_BURST)
+
+        for part in split_message(text):
+            chat.messages.append((part, options))
+            self._queued += 1
+
+        if chat_id not in self._tasks:
+            self._tasks[chat_id] = self._loop.create_task(self._run(chat_id, chat))
+
+    def _next_message(self, messages):
+        text, options = messages.popleft()
+        while messages:
+            next_text, next_options = messages[0]
+            if next_options != options or len(text) + len(next_text) + 2 > MESSAGE_LIMIT:
+                break
+            messages.popleft()
+            text += '\n\n' + next_text
+            self._merged += 1
+        return text, options
+
+    async def _run(self, chat_id, chat):
+        try:
+            while chat.messages:
+                await chat.bucket.acquire()
+                await self._bucket.acquire()
+                # messages queued while waiting are merged too
+                count = len(chat.messages)
+                text, options = self._next_message(chat.messages)
+                self._queued -= count - len(chat.messages)
+                await self._send(chat_id, chat.sender, text, options)
+        finally:
+            del self._tasks[chat_id]
+            if not chat.messages:
+                del self._chats[chat_id]
+
+    async def _send(self, chat_id, sender, text, options):
+        for attempt in range(self._MAX_RETRIES + 1):
+            start = time.monotonic()
+            try:
+                await sender.sendMessage(text, **options)
+                elapsed = time.monotonic() - start
+                SEND_TIME.observe(elapsed)
+                self._sent += 1
+                self._send_time += elapsed
+                return
+            except telepot.exception.TooManyRequestsError as e:
+                SEND_ERRORS.inc(reason='too_many_requests')
+                parameters = (e.json or {}).get('parameters', {})
+                delay = parameters.get('retry_after') or 2 ** attempt
+                warning('chat %s: too many requests, retry in %s seconds', chat_id, delay)
+                self._retries += 1
+                await asyncio.sleep(delay)
+            except Exception as e:
+                error('chat %s: send error %s', chat_id, e)
+                SEND_ERRORS.inc(reason='error')
+                self._errors += 1
+                return
+
+        error('chat %s: message dropped after %s retries', chat_id, self._MAX_RETRIES)
+        self._errors += 1
+
+    def stats(self):
+        return {'queued': self._queued,
+                'chats': len(self._chats),
+                'sent': self._sent,
+                'merged': self._merged,
+                'retries': self._retries,
+                'errors': self._errors,
+                'send_time': self._send_time}
+
+    async def close(self, timeout):
+        tasks = list(self._tasks.values())
+        if tasks:
+            debug('send queue: waiting for %s chats', len(tasks))
+            await asyncio.wait(tasks, timeout=timeout)
+
+
+class QueuedSender:
+    def __init__(self, queue, chat_id, sender):
+        self._queue = queue
+        self._chat_id = chat_id
+        self._sender = sender
+
+    async def sendMessage(self, msg, **kwargs):
+        self._queue.put(self._chat_id, self._sender, msg, kwargs)
@@ -1,15 +1,29 @@
 import asyncio
+import codecs
+import collections
+import concurrent.futures
+import json
+import logging
 import math
 import os
-import shelve
+import re
 import sqlite3
+import threading
 import time
-
-from logging import debug, info, error
+import urllib.request
+import weakref
 
 import telepot
 import telepot.aio
 
+from . import logs
+from . import metrics
+from . import sandbox
+from . import users
+
+_logger = logging.getLogger(__name__)
+debug, info, error = _logger.debug, _logger.info, _logger.error
+
 HELP_MESSAGE = """This bot allows you to play interactive fiction.
 
 In such games, you play the role of a character in a story.  In order to move the story forward, you'll type commands that cause your character to do things. The interpreter will describe what the fictional world looks like. If your action causes a change in the world of the story, the software will usually tell you.
@@ -29,6 +43,10 @@ Examples of commands:
 - "Again" - repeat last command (or in short form just "G")
 - "Wait" - wait until something happenned (or in short form just "Z")
 
+Several commands can be sent in one message, separated by periods or on separate lines, for example "N. Take lamp. Open door". Periods inside quotes and after titles like "Mr." don't separate commands, write `\\.` to keep any other period.
+
+Send "/history 10" to see the last 10 turns of the game again.
+
 Links:
 - [What is interactive fiction](https://en.wikipedia.org/wiki/Interactive_fiction)
 - [How to play interactive fiction](http://www.musicwords.net/if/how_to_play.htm)
@@ -39,6 +57,15 @@ Bot implemented with [FrobTADS](https://github.com/realnc/frobtads) interpretato
 Please report bugs and feature requests to @yktor.
 """
 
+FROB_FIRST_OUTPUT_TIME = metrics.Histogram(
+    'ifictionbot_frob_first_output_seconds', 'Time from game command to interpreter output')
+GAMES_DB_QUERY_TIME = metrics.Histogram(
+    'ifictionbot_games_db_query_seconds', 'Games database query time')
+GAME_START_WAIT_TIME = metrics.Histogram(
+    'ifictionbot_game_start_wait_seconds', 'Time a game start waits in the start queue')
+
+FROB_TRACES = logs.Sampler(_logger)  # turns with interpreter output in debug log
+
 
 def unique_list_prepend(ls, val):
     result = [val]
@@ -46,6 +73,13 @@ def unique_list_prepend(ls, val):
     return result
 
 
+def file_mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
 class GameIterator:
     def __init__(self, db, current_page, page_size, count):
         self._db = db
@@ -53,147 +87,616 @@ class GameIterator:
         self._count = count
         self._current_page = current_page
 
-    def get_page(self):
-        return self._db.get_games(self._current_page * self._page_size, self._page_size)
+    async def get_page(self):
+        return await self._db.get_games(self._current_page * self._page_size, self._page_size)
 
     def get_page_number(self):
         return self._current_page
 
-    def next(self):
-        if self._current_page == self._count:
+    async def next(self):
+        if self._current_page >= self._count - 1:
             debug("Can't iterate next")
         else:
             self._current_page += 1
-        return self.get_page()
+        return await self.get_page()
 
-    def prev(self):
+    async def prev(self):
         if self._current_page == 0:
             debug("Can't iterate prev")
         else:
             self._current_page -= 1
-        return self.get_page()
+        return await self.get_page()
 
     def ways_to_iterate(self):
         return (self._current_page > 0, self._current_page < self._count - 1)
 
 
+class SearchResults:
+    def __init__(self, games):
+        self._games = games
+
+    async def get_games(self, offset, count):
+        return self._games[offset:offset + count]
+
+
 class GamesDB:
-    def __init__(self, path):
-        self._db = sqlite3.connect(path)
+    # shared by all sessions, the games table is loaded in memory and reloaded
+    # when the database file changes, sqlite queries run in worker threads
+    _RELOAD_CHECK_INTERVAL = 10
+    _SEARCH_LIMIT = 60
+    _SEARCH_RANKED = 500  # broader queries are not ranked, bm25 of every match is too slow
+    _SEARCH_QUERY = 'SELECT name FROM fts.games_fts WHERE games_fts MATCH ? LIMIT ?'
+    _RANKED_SEARCH_QUERY = ('SELECT name FROM fts.games_fts WHERE games_fts MATCH ? '
+                            'ORDER BY bm25(games_fts, 10.0, 1.0) LIMIT ?')
+    _SCAN_SEARCH_QUERY = 'SELECT name FROM games WHERE {} ORDER BY name LIMIT ?'
+
+    def __init__(self, loop, path, fts_path, workers=2, mmap_size=0):
+        self._loop = loop
+        self._path = path
+        self._uri = self._make_uri(path)
+        self._fts_path = fts_path  # built by the bot, the games directory may be read-only
+        self._fts_version = 0  # connections reattach full-text index when it changes
+        self._mmap_size = mmap_size
+        self._executor = concurrent.futures.ThreadPoolExecutor(workers)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = []
+        self._queries = 0
+        self._query_time = 0.0
+        self._max_query_time = 0.0
+        self._games = []  # sorted by name
+        self._games_by_name = {}
+        self._mtime = None
+        self._next_check = 0
+        self._reloading = None
+        self._indexing = None
+        self._reloads = 0
 
-    def list_games(self, page, page_size):
-        cur = self._db.cursor()
-        count = int(next(cur.execute('SELECT count(*) FROM games'))[0])
-        pages_count = math.ceil(count / page_size)
+    @staticmethod
+    def _make_uri(path):
+        return 'file:{}?mode=ro'.format(urllib.request.pathname2url(os.path.abspath(path)))
+
+    def _connection(self):
+        db = getattr(self._local, 'db', None)
+        fts_version = self._fts_version
+        if db is not None and self._local.fts_version != fts_version:
+            with self._lock:
+                self._connections.remove(db)
+            db.close()
+            db = None
+
+        if db is None:
+            db = sqlite3.connect(self._uri, uri=True, check_same_thread=False)
+            if self._mmap_size:
+                db.execute('PRAGMA mmap_size = {:d}'.format(self._mmap_size))
+            if fts_version:
+                db.execute('ATTACH DATABASE ? AS fts', (self._make_uri(self._fts_path),))
+            self._local.db = db
+            self._local.fts_version = fts_version
+            with self._lock:
+                self._connections.append(db)
+        return db
+
+    def _build_index(self, games):
+        tmp_path = '{}.{}.tmp'.format(self._fts_path, os.getpid())  # other workers may build too
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+        db = sqlite3.connect(tmp_path)
+        try:
+            db.execute("CREATE VIRTUAL TABLE games_fts USING fts5(name, desc, prefix='1 2 3')")
+            db.executemany('INSERT INTO games_fts VALUES (?, ?)',
+                           ((game[0], game[1]) for game in games))
+            db.execute("INSERT INTO games_fts(games_fts) VALUES('optimize')")
+            db.commit()
+        finally:
+            db.close()
+        os.replace(tmp_path, self._fts_path)
+
+    def _query(self, sql, args):
+        start = time.monotonic()
+        try:
+            return self._connection().execute(sql, args).fetchall()
+        finally:
+            elapsed = time.monotonic() - start
+            GAMES_DB_QUERY_TIME.observe(elapsed)
+            with self._lock:
+                self._queries += 1
+                self._query_time += elapsed
+                self._max_query_time = max(self._max_query_time, elapsed)
+
+    async def _execute(self, sql, args=()):
+        return await self._loop.run_in_executor(self._executor, self._query, sql, args)
+
+    def _search(self, query, limit):
+        # matches are counted up to _SEARCH_RANKED first, a broad query lists
+        # games matched by name before games matched by description
+        matches = len(self._query(self._SEARCH_QUERY, (query, self._SEARCH_RANKED + 1)))
+        if matches <= self._SEARCH_RANKED:
+            return self._query(self._RANKED_SEARCH_QUERY, (query, limit))
+
+        rows = self._query(self._SEARCH_QUERY, ('{{name}} : ({})'.format(query), limit))
+        if len(rows) < limit:
+            found = set(rows)
+            rows += [row for row in self._query(self._SEARCH_QUERY, (query, limit + len(rows)))
+                     if row not in found][:limit - len(rows)]
+        return rows
+
+    async def _scan(self, words, limit):
+        # used until the full-text index is attached, every word is a part of
+        # the name or the description
+        where = ' AND '.join(["(name LIKE ? ESCAPE '\\' OR desc LIKE ? ESCAPE '\\')"] * len(words))
+        args = []
+        for word in words:
+            pattern = '%{}%'.format(word.replace('_', '\\_'))
+            args += [pattern, pattern]
+        return await self._execute(self._SCAN_SEARCH_QUERY.format(where), args + [limit])
+
+    async def _reload(self, mtime):
+        try:
+            games = await self._execute('SELECT * FROM games ORDER BY name')
+            self._games = games
+            self._games_by_name = {game[0]: game for game in games}
+            self._mtime = mtime
+            self._reloads += 1
+            info('games db: %s games loaded', len(games))
+            # listings are served while the full-text index is built
+            self._indexing = self._loop.create_task(self._index(games, mtime, self._indexing))
+        finally:
+            self._reloading = None
+
+    async def _index(self, games, mtime, previous):
+        if previous:
+            await previous
+        fts_mtime = file_mtime(self._fts_path)
+        try:
+            if fts_mtime is None or fts_mtime < mtime:
+                await self._loop.run_in_executor(self._executor, self._build_index, games)
+                info('games db: full-text index built')
+            self._fts_version += 1
+        except (OSError, sqlite3.Error) as e:
+            error('games db: full-text index build error %s', e)
+
+    async def _refresh(self):
+        now = time.monotonic()
+        if self._mtime is not None and now < self._next_check:
+            return
+
+        self._next_check = now + self._RELOAD_CHECK_INTERVAL
+        mtime = file_mtime(self._path)
+        if mtime != self._mtime and not self._reloading:
+            self._reloading = self._loop.create_task(self._reload(mtime))
+
+        reloading = self._reloading
+        if reloading and self._mtime is None:  # nothing to show until first load
+            await reloading
+
+    async def list_games(self, page, page_size):
+        await self._refresh()
+        pages_count = math.ceil(len(self._games) / page_size)
         return GameIterator(self, page, page_size, pages_count)
 
-    def get_games(self, offset, count):
-        cur = self._db.cursor()
-        return cur.execute('SELECT * FROM games LIMIT ? OFFSET ?', (count, offset))
+    async def get_games(self, offset, count):
+        await self._refresh()
+        return self._games[offset:offset + count]
+
+    async def get_game(self, id_):
+        await self._refresh()
+        return self._games_by_name.get(id_)
+
+    async def find_games(self, ids):
+        # games in ids order, None for games not in the catalog
+        await self._refresh()
+        return [self._games_by_name.get(id_) for id_ in ids]
+
+    async def indexed(self):
+        # waits for the full-text index of the loaded catalog
+        await self._refresh()
+        if self._indexing:
+            await self._indexing
+
+    def version(self):
+        # changes when the catalog is reloaded
+        return self._reloads
+
+    async def search_games(self, text, page_size):
+        await self._refresh()
+        games = []
+        words = re.findall(r'\w+', text)
+        if words:
+            query = ' '.join('"{}"*'.format(w) for w in words)  # prefix match of all words
+            try:
+                if self._fts_version:
+                    rows = await self._loop.run_in_executor(
+                        self._executor, self._search, query, self._SEARCH_LIMIT)
+                else:
+                    rows = await self._scan(words, self._SEARCH_LIMIT)
+                games = [self._games_by_name[name] for name, in rows
+                         if name in self._games_by_name]
+            except sqlite3.Error as e:
+                error('games db: search error %s', e)
+
+        pages_count = math.ceil(len(games) / page_size)
+        return GameIterator(SearchResults(games), 0, page_size, pages_count)
+
+    def stats(self):
+        with self._lock:
+            return {'games': len(self._games),
+                    'reloads': self._reloads,
+                    'connections': len(self._connections),
+                    'queries': self._queries,
+                    'query_time': self._query_time,
+                    'max_query_time': self._max_query_time}
 
-    def get_game(self, id_):
-        try:
-            cur = self._db.cursor()
-            return next(cur.execute('SELECT * FROM games WHERE name = ?', (id_,)))
-        except StopIteration:
-            return None
+    def close(self):
+        if self._indexing:
+            self._indexing.cancel()
+        self._executor.shutdown()
+        with self._lock:
+            for db in self._connections:
+                db.close()
+            self._connections.clear()
+
+
+class OutputParser:
+    # turns raw interpreter output into paragraphs as chunks arrive, a
+    # paragraph ends with an empty line or with the end of the turn, lines
+    # of a paragraph are joined with '\n' before capitalized or indented
+    # lines and with ' ' otherwise
+    def __init__(self):
+        self._decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        self._line = ''
+        self._parts = []
+        self._blank = True
+        self._paragraphs = []
+
+    def feed(self, chunk):
+        # returns paragraphs finished by chunk
+        lines = self._decoder.decode(chunk).split('\n')
+        if len(lines) > 1:
+            lines[0] = self._line + lines[0]
+            for line in lines[:-1]:
+                self._add_line(line)
+            self._line = lines[-1]
+        else:
+            self._line += lines[0]
+        return self._take()
+
+    def finish(self):
+        # returns the rest of the turn
+        self._line += self._decoder.decode(b'', True)
+        if self._line:  # last line without '\n'
+            self._add_line(self._line)
+            self._line = ''
+        self._end_paragraph()
+        return self._take()
+
+    def _take(self):
+        paragraphs, self._paragraphs = self._paragraphs, []
+        return paragraphs
+
+    def _add_line(self, line):
+        if line[:1] == '>':
+            line = line[1:]
+
+        if not line:
+            self._end_paragraph()
+            return
+
+        if self._parts:
+            self._parts.append('\n' if line[0].isupper() or line[0] == ' ' else ' ')
+        self._parts.append(line)
+        if self._blank and not line.isspace():
+            self._blank = False
+
+    def _end_paragraph(self):
+        if not self._blank:
+            self._paragraphs.append(''.join(self._parts))
+        self._parts = []
+        self._blank = True
 
 
 class Frob:
-    def __init__(self, chat_id, sender):
+    _CHUNK_SIZE = 64 * 1024
+    _DEFAULT_IDLE_TIMEOUT = 0.1
+    _SAVE_TIMEOUT = 5
+    _PIPELINE_TIMEOUT = 5  # for the prompt after an answer in a pipeline
+    # adv.t asks yes or no questions on the line of the question,
+    # 'Are you sure you want to start over? (YES or NO) > '
+    _QUESTION = re.compile(rb'\?[^\n]*> *')
+    _FINAL_QUESTION = re.compile(rb'\?[^\n]*> *$')
+
+    def __init__(self, chat_id, sender, idle_timeout=_DEFAULT_IDLE_TIMEOUT, limits=None):
         self._chat_id = chat_id
+        self._limits = limits
         self._process = None
         self._sender = sender
         self._messages_to_skip = 0
+        self._idle_timeout = idle_timeout
+        self._path = None
+        self._intro = []
+        self._command_time = None
+        self._commands = collections.deque()  # (command, index, count) waiting for output
+        self._pending = []  # output of the command at the head of _commands so far
+        self._prompting = False  # whether the interpreter was seen printing prompts
+        self._batch = []  # answers of a pipeline sent as one message
+        self._on_turn = None
+        self._screen = []  # messages of the last turn
+        self._usage = (0, 0.0)  # last sample of resident memory and cpu seconds
+
+    def attach(self, chat_id, sender):
+        self._chat_id = chat_id
+        self._sender = sender
 
-    async def start(self, path, game):
-        info("chat %s: frob start", self._chat_id)
-        self._process = await asyncio.create_subprocess_shell(
-            'frob -iplain {}/{}.gam'.format(path, game),
+    async def spawn(self, game_file):
+        self._process = await asyncio.create_subprocess_exec(
+            'frob', '-iplain', game_file,
             stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.STDOUT, preexec_fn=os.setpgrp)
+            stderr=asyncio.subprocess.STDOUT, start_new_session=True)
+        if self._limits:
+            self._limits.apply(self._process.pid)
+        self._intro = [p for _, paragraphs, _ in await self._read_output() for p in paragraphs]
 
-        if os.path.exists(path + '/last.sav'):
-            await self._read_output()  # just ignore all previous output
-            self.restore_game('last')
+    async def start(self, path, game, restore=None, quiet=False):
+        info("chat %s: frob start", self._chat_id)
+        if not self._process:
+            await self.spawn('{}/{}.gam'.format(path, game))
+
+        self._path = path
+        if restore:
+            self._intro = []  # just ignore all previous output
+            self.restore_game(restore)
+            if quiet:
+                await self._wait_prompt(self._SAVE_TIMEOUT)
         else:
             self._messages_to_skip = 1  # ignore frobTADS intro msg
 
-    def stop(self):
+    async def replay(self, commands, timeout=_SAVE_TIMEOUT):
+        # brings the started game to the state after commands, the output is
+        # dropped; commands after one without a prompt are still written, as
+        # the interpreter got them in the game, returns whether every command
+        # was answered
+        info("chat %s: replay %s commands", self._chat_id, len(commands))
+        self._intro = []
+        self._messages_to_skip = 0
+        answered = True
+        for cmd in commands:
+            if not self.is_alive():
+                return False
+            self._process.stdin.write(bytes(cmd + '\n', 'utf-8'))
+            if not await self._wait_prompt(timeout):
+                error("chat %s: frob replay timeout after '%s'", self._chat_id, cmd)
+                answered = False
+        return answered
+
+    def record_turns(self, on_turn):
+        # on_turn(command, paragraphs) is awaited for output of every command
+        self._on_turn = on_turn
+
+    async def stop(self, save_name, timeout=_SAVE_TIMEOUT):
+        # read_loop must be already stopped, the save output is dropped,
+        # returns whether the game was saved
         info("chat %s: frob stop", self._chat_id)
-        if not self._process.returncode:  # process not finished yet
-            self.save_game('last')
-            time.sleep(1)  # TODO don't use sync wait
-            self._process.terminate()
+        if not self.is_alive():
+            return False
+
+        save_file = os.path.join(self._path, save_name + '.sav')
+        mtime = file_mtime(save_file)
+        self.save_game(save_name)
+        saved = await self._wait_prompt(timeout, lambda: file_mtime(save_file) != mtime)
+        if not saved:
+            error("chat %s: frob save timeout", self._chat_id)
+        info("chat %s: frob used %s bytes, %.2f cpu seconds", self._chat_id, *self.sample_usage())
+        self._process.terminate()
+        return saved
+
+    def screen(self):
+        return list(self._screen)
+
+    def is_alive(self):
+        return self._process is not None and self._process.returncode is None
+
+    def sample_usage(self):
+        # reads /proc, may run in a thread
+        if self.is_alive():
+            self._usage = sandbox.process_usage(self._process.pid)
+        return self._usage
+
+    def usage(self):
+        # resident memory in bytes and cpu seconds as last sampled
+        return self._usage
+
+    def kill(self):
+        if self.is_alive():
+            self._process.kill()
 
-    async def _read_output(self):
-        lines = [await self._process.stdout.readline()]
-        try:
-            while not self._process.stdout.at_eof():
-                lines.append(await asyncio.wait_for(self._process.stdout.readline(), 0.1))
-        except asyncio.TimeoutError:
-            pass
+    @staticmethod
+    def _ends_with_prompt(output):
+        # frobTADS prints '>' at the start of a line when it waits for a command
+        return output == b'>' or output.endswith(b'\n>')
 
-        return lines
+    @classmethod
+    def _ends_with_question(cls, output):
+        # output read so far ends with a question waiting for the answer
+        return cls._FINAL_QUESTION.search(output) is not None
 
-    async def read_loop(self):
-        while not self._process.stdout.at_eof():
-            lines = await self._read_output()
-            msgs = self._parse_lines(lines)
-            for msg in msgs:
-                if self._messages_to_skip:
-                    self._messages_to_skip -= 1
-                    continue
+    @classmethod
+    def _questions(cls, chunk):
+        # ends of questions followed by more output in chunk
+        return [m.end() for m in cls._QUESTION.finditer(chunk) if m.end() < len(chunk)]
 
-                await self._sender.sendMessage(msg)
+    @staticmethod
+    def _prompts(tail, chunk):
+        # positions of prompts in chunk, tail is the byte before it
+        found = []
+        if chunk[:1] == b'>' and tail == b'\n':
+            found.append(0)
+        position = chunk.find(b'\n>')
+        while position != -1:
+            found.append(position + 1)
+            position = chunk.find(b'\n>', position + 1)
+        return found
+
+    def _turn(self, paragraphs, done=True):
+        # commands written at once are answered in order, every answer ends
+        # with the prompt; a part of an answer keeps its command waiting
+        if not self._commands:
+            command = None
+        elif done:
+            command = self._commands.popleft()
+        else:
+            command = self._commands[0]
+        if paragraphs and FROB_TRACES.sample():
+            for paragraph in paragraphs:
+                debug('chat %s: frob output: %s', self._chat_id, paragraph)
+        return command, paragraphs, done
 
-        await self._sender.sendMessage('Game closed')
-        info('Frob eof reached')
+    async def _read_output(self):
+        # (command, paragraphs, done) of turns, a turn ends with the prompt or
+        # with the idle timeout when the interpreter prints no prompt; output
+        # before the idle timeout of a prompting interpreter is a part of the
+        # answer, its command is done at the prompt or when a read ends with
+        # a question
+        stdout = self._process.stdout
+        turns = []
+        parser = OutputParser()
+        paragraphs = []
+        tail = b'\n'
+        rest = b''  # output after the last prompt
+        idle = False
+        prompted = False
+        chunk = await stdout.read(self._CHUNK_SIZE)
+        if self._command_time is not None:
+            FROB_FIRST_OUTPUT_TIME.observe(time.monotonic() - self._command_time)
+            self._command_time = None
+        while chunk:
+            start = 0
+            ends = [(prompt, prompt + 1, False) for prompt in self._prompts(tail, chunk)]
+            ends += [(end, end, True) for end in self._questions(chunk)]
+            for end, next_start, question in sorted(ends):
+                if question and len(self._commands) < 2:
+                    continue  # output after a question is the answer to a queued command
+                prompted = True
+                self._prompting = self._prompting or not question
+                paragraphs += parser.feed(chunk[start:end])
+                turns.append(self._turn(paragraphs + parser.finish()))
+                parser = OutputParser()
+                paragraphs = []
+                start = next_start
+            paragraphs += parser.feed(chunk[start:])
+            tail = chunk[-1:]
+            rest = ((rest if start == 0 else b'') + chunk[start:])[-256:]
+            if self._ends_with_question(rest):
+                prompted = True
+                turns.append(self._turn(paragraphs + parser.finish()))
+                parser = OutputParser()
+                paragraphs = []
+                rest = b''
+            if not rest and not self._commands:
+                break
+            # a slow answer is sent in parts unless it belongs to a pipeline
+            # or follows a prompt, then the prompt is waited for
+            timeout = self._idle_timeout
+            if self._commands and (prompted or self._commands[0][2] > 1):
+                timeout = self._PIPELINE_TIMEOUT
+            try:
+                chunk = await asyncio.wait_for(stdout.read(self._CHUNK_SIZE), timeout)
+            except asyncio.TimeoutError:
+                idle = True
+                break
+
+        paragraphs += parser.finish()
+        if paragraphs or not turns:
+            turns.append(self._turn(paragraphs, not self._prompting or stdout.at_eof()))
+        if idle and not self._prompting and self._commands:
+            # the interpreter prints no prompt, the output answered all
+            # waiting commands
+            turns += [self._turn([]) for _ in range(len(self._commands))]
+        return turns
+
+    async def _wait_prompt(self, timeout, done=lambda: True):
+        # drop output until the interpreter asks for the next command or
+        # for the answer to a question
+        stdout = self._process.stdout
+        deadline = time.monotonic() + timeout
+        prompt = False
+        tail = b''
+        while not (prompt and done()):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+
+            try:
+                chunk = await asyncio.wait_for(stdout.read(self._CHUNK_SIZE),
+                                               min(remaining, self._idle_timeout))
+            except asyncio.TimeoutError:
+                continue
+            if not chunk:
+                return False
+
+            tail = (tail + chunk)[-256:]
+            prompt = self._ends_with_prompt(tail) or self._ends_with_question(tail)
+
+        return True
+
+    async def _send_output(self, msgs):
+        sent = []
+        for msg in msgs:
+            if self._messages_to_skip:
+                self._messages_to_skip -= 1
+                continue
+
+            await self._sender.sendMessage(msg)
+            sent.append(msg)
+        if sent:
+            self._screen = sent
+        return sent
+
+    async def _answer(self, command, paragraphs, done):
+        if command is None:
+            await self._send_output(paragraphs)
+            return
 
-    @staticmethod
-    def _get_lines_delimiter(start, end):
-        if not start:
-            return ''
+        cmd, index, count = command
+        self._pending += paragraphs
+        if count == 1:
+            await self._send_output(paragraphs)
+        if not done:
+            return
 
-        if end[0].isupper() or end[0] == ' ':  # try delete redundant '\n'
-            return '\n'
-        else:
-            return ' '
-
-    def _parse_lines(self, blines):
-        lines = [l.decode('utf-8') for l in blines]
-        for l in lines:
-            debug('frob output: %s', l)
-
-        msgs = []
-        last_msg = ''
-        for b in lines:
-            if b:
-                if b[0] == '>':
-                    b = b[1:]
-
-                if b == '\n':  # put paragraphs in separate messages
-                    if last_msg.strip():
-                        msgs.append(last_msg)
-                    last_msg = ''
-                else:
-                    last_msg += self._get_lines_delimiter(last_msg, b)
-                    last_msg += b[:-1]  # without '\n'
+        paragraphs, self._pending = self._pending, []
+        if count > 1:
+            self._batch.append('\n\n'.join(['> ' + cmd] + paragraphs))
+            if index == count - 1:
+                batch, self._batch = self._batch, []
+                await self._send_output(['\n\n'.join(batch)])
+        if self._on_turn:
+            await self._on_turn(cmd, paragraphs)
 
-        if last_msg.strip():
-            msgs.append(last_msg)
+    async def read_loop(self):
+        intro, self._intro = self._intro, []
+        await self._send_output(intro)
+        while not self._process.stdout.at_eof():
+            turns = await self._read_output()
+            for command, paragraphs, done in turns:
+                await self._answer(command, paragraphs, done)
 
-        return msgs
+        if self._batch:  # the interpreter exited in the middle of a pipeline
+            await self._send_output(['\n\n'.join(self._batch)])
+            self._batch = []
+        await self._sender.sendMessage('Game closed')
+        info('Frob eof reached')
 
     def save_game(self, name):
         info("chat %s: save game '%s'", self._chat_id, name)
+        # full path, pooled interpreters are started outside of the user directory
         self._process.stdin.write(bytes('save\n', 'utf-8'))
-        self._process.stdin.write(bytes(name + '\n', 'utf-8'))
+        self._process.stdin.write(bytes(os.path.join(self._path, name) + '\n', 'utf-8'))
 
     def restore_game(self, name):
         info("chat %s: restore game '%s'", self._chat_id, name)
         self._process.stdin.write(bytes('restore\n', 'utf-8'))
-        self._process.stdin.write(bytes(name + '\n', 'utf-8'))
+        self._process.stdin.write(bytes(os.path.join(self._path, name) + '\n', 'utf-8'))
 
     def restart(self):
         info("chat %s: restart", self._chat_id)
@@ -201,17 +704,308 @@ class Frob:
         self._process.stdin.write(bytes('y\n', 'utf-8'))
 
     async def command(self, cmd):
+        await self.pipeline([cmd])
+
+    async def pipeline(self, commands):
+        # commands are written back to back, answers are matched to them by
+        # prompts and sent as one message
         if self._process.returncode:
             await self._sender.sendMessage('Game not started')
         else:
-            info("chat %s: command '%s'", self._chat_id, cmd)
-            self._process.stdin.write(bytes(cmd + '\n', 'utf-8'))
+            for cmd in commands:
+                info("chat %s: command '%s'", self._chat_id, cmd)
+            self._command_time = time.monotonic()
+            self._commands.extend((cmd, i, len(commands)) for i, cmd in enumerate(commands))
+            self._process.stdin.write(''.join(cmd + '\n' for cmd in commands).encode('utf-8'))
+
+
+class StartQueue:
+    # limits the number of interpreters starting at once, the rest wait in
+    # arrival order, a chat waits for one start at a time, background starts
+    # get a slot when no chat waits
+    def __init__(self, loop, concurrency):
+        self._loop = loop
+        self._concurrency = concurrency
+        self._running = 0
+        self._waiting = collections.OrderedDict()  # chat id: future
+        self._background = collections.deque()  # futures
+        self._waited = 0
+        self._max_wait_time = 0.0
+
+    async def enter(self, chat_id, sender):
+        if not self._concurrency or (self._running < self._concurrency and not self._waiting):
+            self._running += 1
+            GAME_START_WAIT_TIME.observe(0)
+            return
+
+        start = time.monotonic()
+        future = self._waiting[chat_id] = self._loop.create_future()
+        self._waited += 1
+        try:
+            await sender.sendMessage(
+                "You're #{} in line, the game will start soon".format(len(self._waiting)))
+            await future  # the slot is passed by leave
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.leave()  # the slot was passed already
+            elif self._waiting.get(chat_id) is future:
+                del self._waiting[chat_id]
+            raise
+
+        wait_time = time.monotonic() - start
+        GAME_START_WAIT_TIME.observe(wait_time)
+        self._max_wait_time = max(self._max_wait_time, wait_time)
+        info('chat %s: started after %.1f seconds in line', chat_id, wait_time)
+
+    async def enter_background(self):
+        if not self._concurrency or (self._running < self._concurrency and not self._waiting
+                                     and not self._background):
+            self._running += 1
+            return
+
+        future = self._loop.create_future()
+        self._background.append(future)
+        try:
+            await future  # the slot is passed by leave
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.leave()  # the slot was passed already
+            elif future in self._background:
+                self._background.remove(future)
+            raise
+
+    def leave(self):
+        while self._waiting:
+            _, future = self._waiting.popitem(last=False)
+            if not future.done():
+                future.set_result(None)
+                return
+        while self._background:
+            future = self._background.popleft()
+            if not future.done():
+                future.set_result(None)
+                return
+        self._running -= 1
+
+    def stats(self):
+        return {'starting': self._running,
+                'waiting': len(self._waiting),
+                'background_waiting': len(self._background),
+                'waited': self._waited,
+                'max_wait_time': self._max_wait_time}
+
+
+class FrobPool:
+    # new interpreters are started while their memory, estimated as the
+    # average of running ones, fits in memory_budget bytes, otherwise
+    # acquire waits up to budget_wait seconds and returns None
+    _DEFAULT_BUDGET_WAIT = 30
+    _BUDGET_CHECK_INTERVAL = 1
+    _USAGE_INTERVAL = 1
+
+    def __init__(self, loop, data_path, idle_timeout=Frob._DEFAULT_IDLE_TIMEOUT, sizes=None,
+                 limits=None, memory_budget=0, budget_wait=_DEFAULT_BUDGET_WAIT, max_starts=0):
+        self._loop = loop
+        self._start_queue = StartQueue(loop, max_starts)
+        self._games_path = os.path.abspath(data_path + '/games')
+        self._idle_timeout = idle_timeout
+        self._sizes = sizes or {}
+        self._limits = limits
+        self._memory_budget = memory_budget
+        self._budget_wait = budget_wait
+        self._idle = {game: [] for game in self._sizes}
+        self._spawning = {game: 0 for game in self._sizes}
+        self._hits = 0
+        self._misses = 0
+        self._waiting = 0
+        self._rejected = 0
+        self._frobs = weakref.WeakSet()  # every interpreter started by the pool
+        self._sampler = None
+
+    def start(self):
+        for game in self._sizes:
+            self._loop.create_task(self._fill(game))
+        self._sampler = self._loop.create_task(self._sample_usage())
+
+    async def _sample_usage(self):
+        # usage of interpreters is read from /proc off the loop, checks of
+        # the budget and stats use the last samples
+        while True:
+            frobs = [frob for frob in self._frobs if frob.is_alive()]
+            try:
+                await self._loop.run_in_executor(
+                    None, lambda: [frob.sample_usage() for frob in frobs])
+            except Exception as e:
+                error('frob pool: usage sampling error %s', e)
+            await asyncio.sleep(self._USAGE_INTERVAL)
+
+    async def _fill(self, game):
+        # refills count against max_starts and wait behind starts of chats
+        while len(self._idle[game]) + self._spawning[game] < self._sizes.get(game, 0):
+            if self._over_budget():
+                return
+            self._spawning[game] += 1
+            try:
+                await self._start_queue.enter_background()
+                try:
+                    if game not in self._sizes:
+                        return  # closed while waiting
+                    frob = Frob(None, None, self._idle_timeout, self._limits)
+                    self._frobs.add(frob)
+                    await frob.spawn('{}/{}.gam'.format(self._games_path, game))
+                finally:
+                    self._start_queue.leave()
+                if game in self._sizes:
+                    self._idle[game].append(frob)
+                else:
+                    frob.kill()
+            except Exception as e:
+                error('frob pool: %s spawn error %s', game, e)
+                return
+            finally:
+                self._spawning[game] -= 1
+
+    def _take(self, game):
+        idle = self._idle.get(game, [])
+        while idle:
+            frob = idle.pop()
+            if frob.is_alive():
+                self._loop.create_task(self._fill(game))
+                return frob
+        return None
+
+    def _usage(self):
+        return [frob.usage() for frob in self._frobs if frob.is_alive()]
+
+    def _over_budget(self):
+        # interpreters not sampled yet and the new one are counted as average
+        if not self._memory_budget:
+            return False
+        usage = self._usage()
+        memory = [rss for rss, _ in usage if rss]
+        if not memory:
+            return False
+        average = sum(memory) / len(memory)
+        return sum(memory) + average * (len(usage) - len(memory) + 1) > self._memory_budget
+
+    async def _admit(self, chat_id):
+        if not self._over_budget():
+            return True
+
+        info('chat %s: memory budget exceeded, waiting', chat_id)
+        deadline = time.monotonic() + self._budget_wait
+        self._waiting += 1
+        try:
+            while time.monotonic() < deadline:
+                await asyncio.sleep(self._BUDGET_CHECK_INTERVAL)
+                if not self._over_budget():
+                    return True
+        finally:
+            self._waiting -= 1
+
+        info('chat %s: memory budget exceeded, game rejected', chat_id)
+        self._rejected += 1
+        return False
+
+    async def acquire(self, chat_id, sender, path, game, restore=None, quiet=False):
+        # None when there is no memory for a new interpreter
+        frob = self._take(game)
+        if frob:
+            self._hits += 1
+            debug('chat %s: frob pool hit for %s', chat_id, game)
+            frob.attach(chat_id, sender)
+            await frob.start(path, game, restore, quiet)
+            return frob
+
+        await self._start_queue.enter(chat_id, sender)
+        try:
+            if not await self._admit(chat_id):
+                return None
+            self._misses += 1
+            debug('chat %s: frob pool miss for %s', chat_id, game)
+            frob = Frob(chat_id, sender, self._idle_timeout, self._limits)
+            self._frobs.add(frob)
+            await frob.start(path, game, restore, quiet)
+            return frob
+        finally:
+            self._start_queue.leave()
+
+    def stats(self):
+        usage = self._usage()
+        return {'hits': self._hits,
+                'misses': self._misses,
+                'idle': {game: len(idle) for game, idle in self._idle.items()},
+                'live': len(usage),
+                'rss': sum(rss for rss, _ in usage),
+                'cpu_time': sum(cpu_time for _, cpu_time in usage),
+                'waiting': self._waiting,
+                'rejected': self._rejected,
+                'start_queue': self._start_queue.stats()}
+
+    def close(self):
+        if self._sampler:
+            self._sampler.cancel()
+        for idle in self._idle.values():
+            for frob in idle:
+                frob.kill()
+            idle.clear()
+        self._sizes = {}
+
+
+class Hibernator:
+    def __init__(self, loop, idle_after=None, max_live=None):
+        self._loop = loop
+        self._idle_after = idle_after
+        self._max_live = max_live
+        self._live = collections.OrderedDict()  # least recently used first
+        self._hibernated = set()
+        self._timers = {}
+
+    def _cancel_timer(self, dialog):
+        timer = self._timers.pop(dialog, None)
+        if timer:
+            timer.cancel()
+
+    def _hibernate(self, dialog):
+        dialog.hibernate()
+
+    def touch(self, dialog):
+        self._hibernated.discard(dialog)
+        self._live[dialog] = True
+        self._live.move_to_end(dialog)
+
+        self._cancel_timer(dialog)
+        if self._idle_after:
+            self._timers[dialog] = self._loop.call_later(
+                self._idle_after, self._hibernate, dialog)
+
+        while self._max_live and len(self._live) > self._max_live:
+            lru = next(iter(self._live))
+            info('hibernator: live interpreters limit reached')
+            self.hibernated(lru)
+            self._hibernate(lru)
+
+    def hibernated(self, dialog):
+        self._cancel_timer(dialog)
+        self._live.pop(dialog, None)
+        self._hibernated.add(dialog)
+
+    def forget(self, dialog):
+        self._cancel_timer(dialog)
+        self._live.pop(dialog, None)
+        self._hibernated.discard(dialog)
+
+    def stats(self):
+        return {'live': len(self._live), 'hibernated': len(self._hibernated)}
+
 
 DIALOG_MAIN = 'main'
 DIALOG_BROWSING = 'browsing'
 DIALOG_LAST_PLAYED = 'last-played'
 DIALOG_GAME = 'game'
 
+LAST_PLAYED_LIMIT = 10
+
 
 class MainDialog:
     _GAMES_DB = 'Games database'
@@ -227,7 +1021,7 @@ class MainDialog:
         if greetings:
             await self._sender.sendMessage('Choose section', reply_markup=self._KEYBOARD)
 
-    def stop(self):
+    async def stop(self):
         pass
 
     async def on_message(self, msg):
@@ -254,16 +1048,20 @@ class BrowsingDialog:
 
     _BACKWARD = '⬅️ Backward'
     _FORWARD = 'Forward ➡️'
+    _ALL_GAMES = 'Show all games'
     _CANCEL = 'Return to the main menu'
 
-    def __init__(self, state, sender, games_db):
+    def __init__(self, state, sender, games_db, render_cache, page_size):
         self._state = state
         if not self._state:
             self._state.update(self._DEFAULT_STATE)
 
         self._games_db = games_db
+        self._render_cache = render_cache
+        self._page_size = page_size
         self._sender = sender
-        self._iterator = self._games_db.list_games(self._state['page'], 3)
+        self._catalog_iterator = None
+        self._iterator = None  # catalog or search results
 
     def _make_keyboard(self):
         to_left, to_right = self._iterator.ways_to_iterate()
@@ -276,23 +1074,44 @@ class BrowsingDialog:
         else:
             browsing_keys = []
 
-        return {'keyboard': [browsing_keys, [self._CANCEL]],
-                'resize_keyboard': True}
+        keyboard = [browsing_keys, [self._CANCEL]]
+        if self._iterator is not self._catalog_iterator:
+            keyboard.insert(1, [self._ALL_GAMES])
+        return {'keyboard': keyboard, 'resize_keyboard': True}
 
     @staticmethod
     def _make_items_list(items):
         result = '\n'.join(('/{} - {}'.format(name, desc) for name, desc in items))
         return result if result else 'Empty'
 
+    def _render_page(self, items):
+        # keyboard is serialized once, telepot passes strings through
+        return (self._make_items_list(items),
+                json.dumps(self._make_keyboard(), separators=(',', ':')))
+
+    async def _send_page(self, items):
+        if self._iterator is self._catalog_iterator:
+            # catalog pages are the same for everyone
+            key = ('catalog-page', self._games_db.version(),
+                   self._iterator.get_page_number(), self._page_size)
+            msg, keyboard = self._render_cache.get(key, lambda: self._render_page(items))
+        else:
+            msg, keyboard = self._render_page(items)
+        await self._sender.sendMessage(msg, reply_markup=keyboard)
+
     async def start(self, greetings=False):
+        self._catalog_iterator = await self._games_db.list_games(
+            self._state['page'], self._page_size)
+        self._iterator = self._catalog_iterator
         if greetings:
-            await self._sender.sendMessage('Here you can see TADS games from ifarchive.org')
+            await self._sender.sendMessage('Here you can see TADS games from ifarchive.org. '
+                                           'Send any text to search games.')
 
-            msg = self._make_items_list(self._iterator.get_page())
-            await self._sender.sendMessage(msg, reply_markup=self._make_keyboard())
+            await self._send_page(await self._iterator.get_page())
 
-    def stop(self):
-        self._state['page'] = self._iterator.get_page_number()
+    async def stop(self):
+        if self._catalog_iterator:
+            self._state['page'] = self._catalog_iterator.get_page_number()
 
     async def on_message(self, msg):
         debug('BrowsingDialog on_message %s', msg)
@@ -302,50 +1121,92 @@ class BrowsingDialog:
 
         text = msg['text']
         if text == self._FORWARD:
-            items = self._iterator.next()
+            items = await self._iterator.next()
         elif text == self._BACKWARD:
-            items = self._iterator.prev()
+            items = await self._iterator.prev()
+        elif text == self._ALL_GAMES:
+            self._iterator = self._catalog_iterator
+            items = await self._iterator.get_page()
         elif text == self._CANCEL:
             return DIALOG_MAIN, {}
         elif text.startswith('/'):
             return DIALOG_GAME, {'game': text[1:]}
         else:
-            items = self._iterator.get_page()
+            self._iterator = await self._games_db.search_games(text, self._page_size)
+            items = await self._iterator.get_page()
+            if not items:
+                await self._sender.sendMessage('Nothing found', reply_markup=self._make_keyboard())
+                return DIALOG_BROWSING, {}
 
-        msg = self._make_items_list(items)
-        await self._sender.sendMessage(msg, reply_markup=self._make_keyboard())
+        await self._send_page(items)
         return DIALOG_BROWSING, {}
 
 
+class RenderCache:
+    # rendered texts shared by all sessions, least recently used are dropped,
+    # keys should include GamesDB.version() for catalog based texts
+    _DEFAULT_SIZE = 10000
+
+    def __init__(self, size=_DEFAULT_SIZE):
+        self._size = size
+        self._items = collections.OrderedDict()
+        self._hits = 0
+        self._misses = 0
+
+    def get(self, key, render):
+        item = self._items.get(key)
+        if item is not None:
+            self._hits += 1
+            self._items.move_to_end(key)
+            return item
+
+        self._misses += 1
+        item = self._items[key] = render()
+        if len(self._items) > self._size:
+            self._items.popitem(last=False)
+        return item
+
+    def stats(self):
+        lookups = self._hits + self._misses
+        return {'items': len(self._items), 'hits': self._hits, 'misses': self._misses,
+                'hit_rate': self._hits / lookups if lookups else 0.0}
+
+
 class LastPlayedDialog:
     _CANCEL = 'Return to the main menu'
     _KEYBOARD = {'keyboard': [[_CANCEL]], 'resize_keyboard': True}
 
-    def __init__(self, state, sender, games_db):
+    def __init__(self, state, sender, games_db, render_cache):
         self._state = state
         self._sender = sender
         self._games_db = games_db
+        self._render_cache = render_cache
 
     async def start(self, greetings=False):
         debug('LastPlayedDialog start %s', greetings)
         if greetings:
             await self._send_last_played_games()
 
+    @staticmethod
+    def _render_game(name, game):
+        if game:
+            return '/{} - {}'.format(*game)
+        else:
+            return '{} - game no more accessible'.format(name)
+
     async def _send_last_played_games(self):
         debug('last played %s', self._state)
+        names = self._state['games']
+        games = await self._games_db.find_games(names)
+        version = self._games_db.version()
         msg_lines = ['Recently played games:']
-        for g in self._state['games']:
-            debug('get game %s', self._games_db.get_game(g))
-            game = self._games_db.get_game(g)
-            if game:
-                msg_lines.append('/{} - {}'.format(*game))
-            else:
-                msg_lines.append('{} - game no more accessible'.format(g))
+        for name, game in zip(names, games):
+            msg_lines.append(self._render_cache.get(
+                ('last-played', version, name), lambda: self._render_game(name, game)))
 
-        debug('send msg %s', msg_lines)
         await self._sender.sendMessage('\n'.join(msg_lines), reply_markup=self._KEYBOARD)
 
-    def stop(self):
+    async def stop(self):
         pass
 
     async def on_message(self, msg):
@@ -364,22 +1225,6 @@ class LastPlayedDialog:
             return DIALOG_LAST_PLAYED, {}
 
 
-def init_user_dir(data_path, user_id):
-    user_path = os.path.abspath('{}/users/{}'.format(data_path, user_id))
-    if not os.path.exists(user_path):
-        os.makedirs(user_path)
-
-
-def init_game_dir(data_path, user_id, game):
-    source_game_path = os.path.abspath('{}/games/{}.gam'.format(data_path, game))
-    game_data_path = os.path.abspath('{}/users/{}/{}'.format(data_path, user_id, game))
-    if not os.path.exists(game_data_path):
-        os.makedirs(game_data_path)
-    game_path = '{}/{}.gam'.format(game_data_path, game)
-    os.system('ln -sf {} {}'.format(source_game_path, game_path))
-    return game_data_path
-
-
 class SenderWithKeyboard:
     def __init__(self, sender, keyboard):
         self._sender = sender
@@ -393,17 +1238,81 @@ class GameDialog:
     _RETURN = 'Return to the main menu'
     _KEYBOARD = {'keyboard': [['Status', 'Undo', 'Restart'], [_RETURN]],
                  'resize_keyboard': True}
-
-    def __init__(self, state, last_played, loop, chat_id, sender, data_path, games_db):
+    _HISTORY_TURNS = 5
+    _HISTORY_LIMIT = 50
+    _REPLAY_LIMIT = 1000
+    _MAX_COMMANDS = 20  # in one message
+    # 'n. take lamp' or lines, periods in quotes, after titles and escaped as
+    # '\.' are kept: 'say "Hi. Bye"', 'ask Mr. Smith about key', 'write Hi\. Bye'
+    _COMMAND_SEPARATOR = re.compile(
+        r'"[^"]*"?|\\\.|(?<!\w)(?i:mrs?|ms|dr|st|mt|jr|sr|prof)\.|(?P<separator>\n|\.(?=\s|$))')
+
+    def __init__(self, state, last_played, loop, chat_id, sender, workspaces, snapshots,
+                 transcripts, games_db, frob_pool, hibernator):
         self._state = state
         self._last_played = last_played
         self._loop = loop
         self._chat_id = chat_id
         self._sender = sender
-        self._data_path = data_path
+        self._workspaces = workspaces
+        self._snapshots = snapshots
+        self._transcripts = transcripts
         self._games_db = games_db
+        self._frob_pool = frob_pool
+        self._hibernator = hibernator
         self._game = None
+        self._game_name = None
+        self._game_path = None
+        self._screen = []  # of the latest save, kept when the game shows nothing new
         self._read_loop_task = None
+        self._hibernated = False
+        self._lock = asyncio.Lock()
+
+    async def _lost_turns(self, game, restore, turn):
+        # turns played after the latest save, the bot was not stopped cleanly
+        if restore and turn is None:
+            return []  # saved before turns were recorded
+        if await self._transcripts.count(self._chat_id, game) <= (turn or 0):
+            return []
+        turns = await self._transcripts.turns(self._chat_id, game, turn or 0)
+        if len(turns) > self._REPLAY_LIMIT:
+            error('chat %s: %s lost turns are not replayed', self._chat_id, len(turns))
+            return []
+        return turns
+
+    async def _launch(self, game, resume=False):
+        sender = SenderWithKeyboard(self._sender, self._KEYBOARD)
+        self._game_name = game
+        self._game_path = await self._workspaces.game_dir(self._chat_id, game)
+        restore, screen, turn = await self._snapshots.latest(self._game_path)
+        lost = await self._lost_turns(game, restore, turn)
+        if lost:
+            screen = lost[-1]['paragraphs'] or screen
+        self._screen = screen
+        if not resume:
+            # show the saved screen at once, the restore output is dropped
+            for msg in screen:
+                await sender.sendMessage(msg)
+        self._game = await self._frob_pool.acquire(
+            self._chat_id, sender, self._game_path, game, restore,
+            resume or bool(screen) or bool(lost))
+        if not self._game:
+            # launched again on the next command
+            self._hibernated = True
+            self._hibernator.hibernated(self)
+            await sender.sendMessage('Too many games are running now, please try again later')
+            return False
+
+        if lost:
+            info('chat %s: replay %s lost turns', self._chat_id, len(lost))
+            if not await self._game.replay([t['command'] for t in lost]):
+                error('chat %s: lost turns of %s not replayed cleanly', self._chat_id, game)
+                await sender.sendMessage('The last turns could not be fully restored, '
+                                         'the game may differ from the last screen')
+        self._game.record_turns(self._record_turn)
+        self._hibernated = False
+        self._hibernator.touch(self)
+        return True
 
     async def start(self, game=None, greetings=False):
         if game:
@@ -411,23 +1320,99 @@ class GameDialog:
         else:
             game = self._state['game']
 
-        self._last_played['games'] = unique_list_prepend(self._last_played['games'], game)[:10]
-
-        sender = SenderWithKeyboard(self._sender, self._KEYBOARD)
-        self._game = Frob(self._chat_id, sender)
-        data_path = init_game_dir(self._data_path, self._chat_id, game)
-        await self._game.start(data_path, game)
-        self._read_loop_task = self._loop.create_task(self._game.read_loop())
-        if greetings:
-            await self._sender.sendMessage(
-                'Starting "{}" game'.format(game), reply_markup=self._KEYBOARD)
-
-    def stop(self):
+        self._last_played['games'] = unique_list_prepend(
+            self._last_played['games'], game)[:LAST_PLAYED_LIMIT]
+
+        async with self._lock:
+            if greetings:
+                await self._sender.sendMessage(
+                    'Starting "{}" game'.format(game), reply_markup=self._KEYBOARD)
+            if await self._launch(game):
+                self._read_loop_task = self._loop.create_task(self._game.read_loop())
+
+    async def _stop_game(self):
+        game, self._game = self._game, None
+        read_loop_task, self._read_loop_task = self._read_loop_task, None
+        if read_loop_task:  # not started when the launch failed
+            read_loop_task.cancel()
+            try:
+                await read_loop_task
+            except asyncio.CancelledError:
+                pass
+            except Exception as e:
+                error('chat %s: read loop error %s', self._chat_id, e)
+        save_name = self._snapshots.next_name(self._game_path)
+        saved = await game.stop(save_name)
+        self._add_usage(*game.usage())
+        if saved:
+            turn = await self._transcripts.count(self._chat_id, self._game_name)
+            await self._snapshots.commit(self._game_path, save_name,
+                                         game.screen() or self._screen, turn)
+
+    def _add_usage(self, rss, cpu_time):
+        # peak memory and cpu seconds of all interpreters of the game
+        usage = self._state.setdefault('usage', {}).setdefault(
+            self._game_name, {'rss': 0, 'cpu_time': 0.0})
+        usage['rss'] = max(usage['rss'], rss)
+        usage['cpu_time'] += cpu_time
+
+    async def _record_turn(self, command, paragraphs):
+        await self._transcripts.append(self._chat_id, self._game_name, command, paragraphs)
+
+    async def _send_history(self, arg):
+        count = int(arg) if arg.isdigit() else self._HISTORY_TURNS
+        turns = await self._transcripts.last(
+            self._chat_id, self._state['game'], min(count, self._HISTORY_LIMIT))
+        if not turns:
+            await self._sender.sendMessage('No turns played yet', reply_markup=self._KEYBOARD)
+        for turn in turns:
+            text = '\n\n'.join(['> ' + turn['command']] + turn['paragraphs'])
+            await self._sender.sendMessage(text, reply_markup=self._KEYBOARD)
+
+    async def stop(self):
         debug('stop game dialog')
-        if self._game:
-            self._game.stop()
-            self._read_loop_task.cancel()
-            self._game = None
+        self._hibernator.forget(self)
+        async with self._lock:
+            self._hibernated = False
+            if self._game:
+                await self._stop_game()
+
+    def hibernate(self):
+        # the game is marked at once, a command arriving before it is
+        # stopped keeps it running
+        if self._game and not self._hibernated:
+            self._hibernated = True
+            self._loop.create_task(self._hibernate())
+
+    async def _hibernate(self):
+        async with self._lock:
+            if not self._game or not self._hibernated:
+                return
+
+            info('chat %s: hibernate game', self._chat_id)
+            self._hibernator.hibernated(self)
+            await self._stop_game()
+
+    async def _resume(self):
+        async with self._lock:
+            if self._hibernated and self._game:
+                debug('chat %s: hibernation cancelled', self._chat_id)
+                self._hibernated = False
+            elif self._hibernated:
+                info('chat %s: resume game', self._chat_id)
+                if await self._launch(self._state['game'], resume=True):
+                    self._read_loop_task = self._loop.create_task(self._game.read_loop())
+
+    @classmethod
+    def _split_commands(cls, text):
+        commands = []
+        start = 0
+        for match in cls._COMMAND_SEPARATOR.finditer(text):
+            if match.group('separator'):
+                commands.append(text[start:match.start()])
+                start = match.end()
+        commands.append(text[start:])
+        return [c.replace('\\.', '.') for c in commands]
 
     async def on_message(self, msg):
         debug('GameDialog on_message')
@@ -436,46 +1421,32 @@ class GameDialog:
             return
 
         text = msg['text']
-        if text.startswith('/command'):
+        if text.startswith('/history'):
+            await self._send_history(text[9:].strip())
+            return DIALOG_GAME, {}
+        elif text.startswith('/command'):
             text = text[9:]
         elif text.startswith('/c'):
             text = text[3:]
 
-        if text.lower() in ['save', 'restore', 'quit', 'q']:
-            await self._sender.sendMessage('This command currently unsupported',
-                                           reply_markup=self._KEYBOARD)
-            return DIALOG_GAME, {}
-        elif text == self._RETURN:
+        if text == self._RETURN:
             return DIALOG_MAIN, {}
-        elif not text:
-            return DIALOG_GAME, {}
-        else:
-            await self._game.command(text)
-            return DIALOG_GAME, {}
-
-
-class UserDB:
-    def __init__(self, data_path, user_id, init_state):
-        self._db = shelve.open('{}/users/{}/user.shlv'.format(data_path, user_id))
-        self._user_id = user_id
-
-        for key, value in init_state.items():
-            if key not in self._db:
-                self._db[key] = value
 
-        self._db.sync()
-
-    def current_state(self):
-        return dict(self._db)
-
-    def save_state(self, state):
-        for key, value in state.items():
-            self._db[key] = value
-
-        self._db.sync()
-
-    def close(self):
-        self._db.close()
+        commands = [c.strip() for c in self._split_commands(text) if c.strip()]
+        if any(c.lower() in ['save', 'restore', 'quit', 'q'] for c in commands):
+            await self._sender.sendMessage('This command currently unsupported',
+                                           reply_markup=self._KEYBOARD)
+        elif commands:
+            if len(commands) > self._MAX_COMMANDS:
+                commands = commands[:self._MAX_COMMANDS]
+                await self._sender.sendMessage(
+                    'Only the first {} commands are run'.format(self._MAX_COMMANDS),
+                    reply_markup=self._KEYBOARD)
+            await self._resume()
+            if self._game:
+                self._hibernator.touch(self)
+                await self._game.pipeline(commands)
+        return DIALOG_GAME, {}
 
 
 class SessionRegistry:
@@ -490,47 +1461,70 @@ class SessionRegistry:
         info('chat %s: session unregister', chat_id)
         del self._sessions[chat_id]
 
-    def close_all(self):
-        closing_sessions = dict(self._sessions)
-        for session in closing_sessions.values():
-            session.close()
+    def stats(self):
+        return {'sessions': len(self._sessions)}
 
+    async def close_all(self, timeout):
+        closing_sessions = list(self._sessions.values())
+        if not closing_sessions:
+            return
 
-def add_to_recently_played(arr, val):
-    if val in arr:
-        arr.remove(val)
-
-    arr.insert(0, val)
+        _, pending = await asyncio.wait(
+            [asyncio.ensure_future(s.close()) for s in closing_sessions], timeout=timeout)
+        if pending:
+            error('%s sessions not closed in %s seconds', len(pending), timeout)
 
 
 class Session(telepot.aio.helper.ChatHandler):
     _DEFAULT_STATE = {'current': DIALOG_MAIN,
-                      'recently_played': [],
                       DIALOG_MAIN: {},
                       DIALOG_GAME: {},
                       DIALOG_LAST_PLAYED: {'games': []},
                       DIALOG_BROWSING: {}}
 
-    def __init__(self, seed_tuple, data_path, loop, registry, **kwargs):
+    def __init__(self, seed_tuple, workspaces, snapshots, transcripts, loop, registry, user_store,
+                 games_db, render_cache, page_size, frob_pool, hibernator, send_queue, **kwargs):
         super(Session, self).__init__(seed_tuple, **kwargs)
         self._chat_id = seed_tuple[1]['chat']['id']
         info('Start session %s', self._chat_id)
-        init_user_dir(data_path, self._chat_id)
-        self._user_db = UserDB(data_path, self._chat_id, self._DEFAULT_STATE)
-        games_db = GamesDB(data_path + '/games/ifarchive.db')
+        self._outbox = send_queue.sender(self._chat_id, self.sender)
+        self._user_db = users.UserDB(user_store, self._chat_id, self._DEFAULT_STATE)
         self._state = self._user_db.current_state()
-        self._dialogs = {
-            DIALOG_MAIN: MainDialog(self.sender),
-            DIALOG_BROWSING: BrowsingDialog(
-                self._state[DIALOG_BROWSING], self.sender, games_db),
-            DIALOG_LAST_PLAYED: LastPlayedDialog(
-                self._state[DIALOG_LAST_PLAYED], self.sender, games_db),
-            DIALOG_GAME: GameDialog(
-                self._state[DIALOG_GAME], self._state[DIALOG_LAST_PLAYED], loop,
-                self._chat_id, self.sender, data_path, games_db)
-        }
+        self._state.pop('recently_played', None)  # duplicated last played games before
+        self._loop = loop
+        self._workspaces = workspaces
+        self._snapshots = snapshots
+        self._transcripts = transcripts
+        self._games_db = games_db
+        self._render_cache = render_cache
+        self._page_size = page_size
+        self._frob_pool = frob_pool
+        self._hibernator = hibernator
+        self._dialogs = {}  # created on first use
         self._registry = registry
 
+    def _make_dialog(self, name):
+        if name == DIALOG_MAIN:
+            return MainDialog(self._outbox)
+        elif name == DIALOG_BROWSING:
+            return BrowsingDialog(self._state[DIALOG_BROWSING], self._outbox, self._games_db,
+                                  self._render_cache, self._page_size)
+        elif name == DIALOG_LAST_PLAYED:
+            return LastPlayedDialog(
+                self._state[DIALOG_LAST_PLAYED], self._outbox, self._games_db,
+                self._render_cache)
+        else:
+            return GameDialog(
+                self._state[DIALOG_GAME], self._state[DIALOG_LAST_PLAYED], self._loop,
+                self._chat_id, self._outbox, self._workspaces, self._snapshots, self._transcripts,
+                self._games_db, self._frob_pool, self._hibernator)
+
+    def _dialog(self, name):
+        dialog = self._dialogs.get(name)
+        if dialog is None:
+            dialog = self._dialogs[name] = self._make_dialog(name)
+        return dialog
+
     async def open(self, msg, dummy_seed):
         try:
             info('chat %s: open', self._chat_id)
@@ -540,7 +1534,7 @@ class Session(telepot.aio.helper.ChatHandler):
             if content_type == 'text' and msg['text'] == '/start':
                 self._state['current'] = DIALOG_MAIN
 
-            await self._dialogs[self._state['current']].start()
+            await self._dialog(self._state['current']).start()
             return False  # process initial message
         except Exception as e:
             error('chat %s: open error %s', self._chat_id, e)
@@ -556,19 +1550,19 @@ class Session(telepot.aio.helper.ChatHandler):
             text = msg['text']
             debug('chat %s: recv from user "%s"', self._chat_id, text)
             if text == '/help':
-                await self.sender.sendMessage(HELP_MESSAGE, parse_mode='Markdown')
+                await self._outbox.sendMessage(HELP_MESSAGE, parse_mode='Markdown')
             elif text.startswith('/game'):
                 game = text[6:]
                 if not game:
-                    await self.sender.sendMessage(
+                    await self._outbox.sendMessage(
                         'Please spicify valid game name. Your can find it through game browser')
                 else:
                     await self._apply_state(DIALOG_GAME, {'game': game})
-            elif text.startswith('/command') or text.startswith('/c'):
+            elif text.startswith(('/command', '/c', '/history')):
                 if self._state['current'] == DIALOG_GAME:
                     await self._pass_message(msg)
                 else:
-                    await self.sender.sendMessage('This command works only when game opened')
+                    await self._outbox.sendMessage('This command works only when game opened')
             else:
                 await self._pass_message(msg)
 
@@ -577,27 +1571,24 @@ class Session(telepot.aio.helper.ChatHandler):
             raise
 
     async def _pass_message(self, msg):
-        new_state, args = await self._dialogs[self._state['current']].on_message(msg)
+        new_state, args = await self._dialog(self._state['current']).on_message(msg)
         if new_state != self._state['current']:
             await self._apply_state(new_state, args)
 
     async def _apply_state(self, state, args):
-        if state == DIALOG_GAME:
-            add_to_recently_played(self._state['recently_played'], args['game'])
-
-        self._dialogs[self._state['current']].stop()
+        await self._dialog(self._state['current']).stop()
         self._state['current'] = state
-        await self._dialogs[self._state['current']].start(**args, greetings=True)
+        await self._dialog(self._state['current']).start(**args, greetings=True)
 
     async def on__idle(self, event):
         info('chat %s: on__idle %s', self._chat_id, event)
-        self.close()
+        await self.close()
         super().on__idle(event)
 
-    def close(self):
+    async def close(self):
         info('chat %s: close', self._chat_id)
         for d in self._dialogs.values():
-            d.stop()
+            await d.stop()
         self._user_db.save_state(self._state)
         self._user_db.close()
         self._registry.unregister(self._chat_id)
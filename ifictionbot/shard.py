@@ -0,0 +1,208 @@
+import asyncio
+import json
+import logging
+import signal
+import sys
+import time
+
+_logger = logging.getLogger(__name__)
+info, error = _logger.info, _logger.error
+
+
+def update_chat_id(update):
+    for key in ('message', 'edited_message', 'channel_post', 'edited_channel_post'):
+        if key in update:
+            return update[key]['chat']['id']
+    if 'callback_query' in update:
+        return update['callback_query']['from']['id']
+    for key in ('inline_query', 'chosen_inline_result'):
+        if key in update:
+            return update[key]['from']['id']
+    return 0
+
+
+def shard_of(chat_id, count):
+    return hash(int(chat_id)) % count
+
+
+class Shard:
+    def __init__(self, number):
+        self.number = number
+        self.process = None
+        self.pending = []  # updates received while worker restarts
+        self.updates = 0
+        self.restarts = 0
+        self.stats = {}
+
+
+class Supervisor:
+    # receives telegram updates and passes them to worker processes by chat id,
+    # every worker runs its own sessions
+    _RESTART_DELAY = 1
+    _REPORT_INTERVAL = 60
+
+    def __init__(self, loop, bot, worker_argv, workers):
+        self._loop = loop
+        self._bot = bot
+        self._worker_argv = worker_argv
+        self._shards = [Shard(i) for i in range(workers)]
+        self._closing = False
+        self._tasks = []
+
+    def start(self, poll=True):
+        for shard in self._shards:
+            self._tasks.append(self._loop.create_task(self._keep_running(shard)))
+        self._tasks.append(self._loop.create_task(self._report()))
+        if poll:  # otherwise updates come to dispatch() from webhook
+            self._tasks.append(self._loop.create_task(poll_updates(self._bot, self.dispatch)))
+
+    async def _keep_running(self, shard):
+        while not self._closing:
+            shard.process = await asyncio.create_subprocess_exec(
+                sys.executable, '-m', 'ifictionbot', *self._worker_argv,
+                '--shard', str(shard.number),
+                stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE,
+                start_new_session=True)  # SIGINT is passed by supervisor
+            info('shard %s: worker %s started', shard.number, shard.process.pid)
+            pending, shard.pending = shard.pending, []
+            for update in pending:
+                self._write(shard, update)
+
+            await self._read_stats(shard)
+            code = await shard.process.wait()
+            shard.process = None
+            if self._closing:
+                break
+
+            error('shard %s: worker exited with %s, restarting', shard.number, code)
+            shard.restarts += 1
+            await asyncio.sleep(self._RESTART_DELAY)
+
+    async def _read_stats(self, shard):
+        # worker reports its load as json lines on stdout
+        async for line in shard.process.stdout:
+            try:
+                shard.stats = json.loads(line.decode('utf-8'))
+            except ValueError:
+                error('shard %s: bad stats line %s', shard.number, line)
+
+    def _write(self, shard, update):
+        # a worker may exit before its returncode is set, then the update is
+        # kept for the restarted worker, the transport closes itself on a
+        # broken pipe instead of raising
+        stdin = shard.process.stdin
+        if not stdin.is_closing():
+            try:
+                stdin.write(json.dumps(update).encode('utf-8') + b'\n')
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+            if not stdin.is_closing():
+                return
+        error('shard %s: worker stdin is closed, update kept until restart', shard.number)
+        shard.pending.append(update)
+
+    def dispatch(self, update):
+        shard = self._shards[shard_of(update_chat_id(update), len(self._shards))]
+        shard.updates += 1
+        if shard.process and shard.process.returncode is None:
+            self._write(shard, update)
+        else:
+            shard.pending.append(update)
+
+    def stats(self):
+        return [dict(shard.stats, shard=shard.number, updates=shard.updates,
+                     restarts=shard.restarts) for shard in self._shards]
+
+    def collect(self):
+        # metrics collector, worker stats are exported labeled by shard
+        for shard_stats in self.stats():
+            labels = {'shard': shard_stats['shard']}
+            yield 'ifictionbot_shard_updates', shard_stats['updates'], labels
+            yield 'ifictionbot_shard_restarts', shard_stats['restarts'], labels
+            for provider_name, provider_stats in shard_stats.items():
+                if isinstance(provider_stats, dict):
+                    for key, value in provider_stats.items():
+                        if isinstance(value, (int, float)):
+                            yield ('ifictionbot_{}_{}'.format(provider_name, key),
+                                   value, labels)
+
+    async def _report(self):
+        while True:
+            await asyncio.sleep(self._REPORT_INTERVAL)
+            for shard_stats in self.stats():
+                info('shard load %s', json.dumps(shard_stats, sort_keys=True))
+
+    async def close(self, timeout):
+        self._closing = True
+        for task in self._tasks[len(self._shards):]:
+            task.cancel()
+
+        processes = [s.process for s in self._shards if s.process]
+        for process in processes:
+            process.stdin.close()
+            process.send_signal(signal.SIGINT)
+        if processes:
+            await asyncio.wait([asyncio.ensure_future(p.wait()) for p in processes],
+                               timeout=timeout)
+            for process in processes:
+                if process.returncode is None:
+                    process.kill()
+
+
+async def poll_updates(bot, handler):
+    # telepot's message loop swallows cancellation, this one stops on it
+    offset = None
+    while True:
+        try:
+            updates = await bot.getUpdates(offset=offset, timeout=20)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            error('get updates error %s', e)
+            await asyncio.sleep(0.1)
+            continue
+
+        for update in updates:
+            offset = update['update_id'] + 1
+            try:
+                handler(update)
+            except Exception as e:
+                error('update %s error %s', update['update_id'], e)
+
+
+async def handle_updates(bot, queue):
+    # updates of webhook or supervisor to the bot, stops when cancelled
+    while True:
+        update = await queue.get()
+        try:
+            handle_update(bot, update)
+        except Exception as e:
+            error('update error %s', e)
+
+
+def handle_update(bot, update):
+    if isinstance(update, bytes):
+        update = json.loads(update.decode('utf-8'))
+    for key in ('message', 'edited_message', 'callback_query', 'inline_query',
+                'chosen_inline_result'):
+        if key in update:
+            bot.handle(update[key])
+            return
+
+
+async def read_updates(loop, queue):
+    # worker side, updates come from supervisor through stdin
+    reader = asyncio.StreamReader()
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+    async for line in reader:
+        await queue.put(line)
+    info('shard: supervisor closed updates stream')
+
+
+async def report_stats(providers, interval):
+    while True:
+        stats = {name: provider.stats() for name, provider in providers.items()}
+        stats['time'] = time.time()
+        sys.stdout.write(json.dumps(stats) + '\n')
+        sys.stdout.flush()
+        await asyncio.sleep(interval)
@@ -0,0 +1,166 @@
+import collections
+import concurrent.futures
+import json
+import logging
+import os
+import re
+
+from . import shard
+
+_logger = logging.getLogger(__name__)
+debug, info = _logger.debug, _logger.info
+
+
+class Snapshots:
+    # versioned saves of every user game with the last screen shown before
+    # the save, old versions are removed above keep per game and quota bytes
+    # in total, the latest version of a game is never removed; a worker
+    # process counts only users of its shard
+    _DEFAULT_KEEP = 3
+    _NAME = re.compile(r'^(?:last|snapshot\.(\d+))\.sav$')
+
+    def __init__(self, loop, data_path, keep=_DEFAULT_KEEP, quota=0, shard_number=None,
+                 workers=0):
+        self._loop = loop
+        self._users_path = os.path.abspath(data_path + '/users')
+        self._keep = keep
+        self._quota = quota
+        self._shard_number = shard_number
+        self._workers = workers
+        self._executor = concurrent.futures.ThreadPoolExecutor(1)
+        self._versions = collections.defaultdict(list)  # game path: sorted versions
+        self._sizes = collections.OrderedDict()  # (game path, version): bytes, oldest first
+        self._usage = 0
+        self._collected = 0
+        self._scan = None
+
+    @staticmethod
+    def name(version):
+        return 'last' if version == 0 else 'snapshot.{}'.format(version)  # 'last' is legacy
+
+    def start(self):
+        self._scan = self._loop.create_task(self._load())
+
+    async def _load(self):
+        found = await self._loop.run_in_executor(self._executor, self._scan_files)
+        for _, path, version, size in sorted(found):
+            self._add(path, version, size)
+        info('snapshots: %s found, %s bytes', len(found), self._usage)
+
+    def _owns(self, user):
+        if self._shard_number is None:
+            return True
+        try:
+            return shard.shard_of(user, self._workers) == self._shard_number
+        except ValueError:  # not a chat id
+            return False
+
+    def _scan_files(self):
+        found = []
+        for user in os.listdir(self._users_path) if os.path.isdir(self._users_path) else []:
+            if not self._owns(user):
+                continue
+            user_path = os.path.join(self._users_path, user)
+            for game in os.listdir(user_path) if os.path.isdir(user_path) else []:
+                path = os.path.join(user_path, game)
+                for file_name in os.listdir(path) if os.path.isdir(path) else []:
+                    match = self._NAME.match(file_name)
+                    if match:
+                        version = int(match.group(1) or 0)
+                        stat = os.stat(os.path.join(path, file_name))
+                        found.append((stat.st_mtime, path, version,
+                                      stat.st_size + self._screen_size(path, version)))
+        return found
+
+    def _screen_file(self, path, version):
+        return os.path.join(path, self.name(version) + '.txt')
+
+    def _screen_size(self, path, version):
+        try:
+            return os.path.getsize(self._screen_file(path, version))
+        except OSError:
+            return 0
+
+    def _add(self, path, version, size):
+        versions = self._versions[path]
+        versions.append(version)
+        versions.sort()
+        self._sizes[(path, version)] = size
+        self._usage += size
+
+    async def latest(self, path):
+        # name of the latest save, its screen messages and the number of game
+        # turns before it, None when unknown
+        await self._scan
+        versions = self._versions.get(path)
+        if not versions:
+            return None, [], None
+        version = versions[-1]
+        screen, turn = await self._loop.run_in_executor(
+            self._executor, self._read_screen, path, version)
+        return self.name(version), screen, turn
+
+    def _read_screen(self, path, version):
+        try:
+            with open(self._screen_file(path, version)) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return [], None
+        if isinstance(data, list):  # screen only before turns were counted
+            return data, None
+        return data['screen'], data['turn']
+
+    def next_name(self, path):
+        versions = self._versions.get(path)
+        return self.name(versions[-1] + 1 if versions else 1)
+
+    async def commit(self, path, name, screen, turn=None):
+        # called after the interpreter saved name
+        version = int(self._NAME.match(name + '.sav').group(1) or 0)
+        size = await self._loop.run_in_executor(
+            self._executor, self._write_screen, path, version, screen, turn)
+        self._add(path, version, size)
+        expired = self._expire(path)
+        if expired:
+            await self._loop.run_in_executor(self._executor, self._remove, expired)
+            debug('snapshots: %s collected, %s bytes used', len(expired), self._usage)
+
+    def _write_screen(self, path, version, screen, turn):
+        with open(self._screen_file(path, version), 'w') as f:
+            json.dump({'screen': screen, 'turn': turn}, f)
+        return (os.path.getsize(self._screen_file(path, version)) +
+                os.path.getsize(os.path.join(path, self.name(version) + '.sav')))
+
+    def _expire(self, path):
+        # versions above keep for the game, then the oldest versions of all
+        # games while usage is above quota
+        expired = [(path, version) for version in self._versions[path][:-self._keep]]
+        if self._quota:
+            usage = self._usage - sum(self._sizes[key] for key in expired)
+            for key, size in self._sizes.items():
+                if usage <= self._quota:
+                    break
+                key_path, version = key
+                if version != self._versions[key_path][-1] and key not in expired:
+                    expired.append(key)
+                    usage -= size
+
+        for key_path, version in expired:
+            self._versions[key_path].remove(version)
+            self._usage -= self._sizes.pop((key_path, version))
+            self._collected += 1
+        return expired
+
+    def _remove(self, expired):
+        for path, version in expired:
+            for file_name in (self.name(version) + '.sav', self.name(version) + '.txt'):
+                try:
+                    os.unlink(os.path.join(path, file_name))
+                except FileNotFoundError:
+                    pass
+
+    def stats(self):
+        return {'snapshots': len(self._sizes), 'bytes': self._usage, 'collected': self._collected}
+
+    def close(self):
+        self._executor.shutdown()
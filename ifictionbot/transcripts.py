@@ -0,0 +1,232 @@
+import asyncio
+import concurrent.futures
+import fcntl
+import json
+import logging
+import os
+import sqlite3
+import struct
+import time
+import zlib
+
+from . import metrics
+
+_logger = logging.getLogger(__name__)
+debug, info, error = _logger.debug, _logger.info, _logger.error
+
+TRANSCRIPT_FLUSH_TIME = metrics.Histogram(
+    'ifictionbot_transcript_flush_seconds', 'Time to append a batch of game turns')
+
+
+class Transcripts:
+    # turns (command and output paragraphs) of every user game in one log
+    # shared by all worker processes, a flush appends a zlib compressed
+    # segment of new turns per game, each segment is prefixed with its
+    # length, a sqlite index maps games and turn numbers to segments
+    _DEFAULT_FLUSH_INTERVAL = 5
+    _HEADER = struct.Struct('>I')
+
+    def __init__(self, loop, data_path, flush_interval=_DEFAULT_FLUSH_INTERVAL):
+        self._loop = loop
+        self._log_path = data_path + '/transcripts.log'
+        self._index_path = data_path + '/transcripts.db'
+        self._flush_interval = flush_interval
+        self._executor = concurrent.futures.ThreadPoolExecutor(1)  # owns the files
+        self._log = None
+        self._index = None
+        self._counts = {}  # (user id, game): turns recorded
+        self._pending = {}  # (user id, game): turns not written yet
+        self._flushing = {}
+        self._open_task = None
+        self._flush_task = None
+        self._flush_lock = asyncio.Lock()
+        self._flushes = 0
+        self._segments = 0
+        self._bytes = 0
+        self._flush_time = 0.0
+
+    def start(self):
+        # jobs run in order on the executor, so nothing waits for the open
+        opened = self._loop.run_in_executor(self._executor, self._open_files)
+        self._open_task = self._loop.create_task(self._open(opened))
+        self._flush_task = self._loop.create_task(self._flush_loop())
+
+    async def _open(self, opened):
+        recovered = await opened
+        if recovered:
+            info('transcripts: %s segments indexed from the log', recovered)
+
+    def _open_files(self):
+        self._index = sqlite3.connect(self._index_path, check_same_thread=False)
+        self._index.execute('PRAGMA journal_mode = WAL')
+        self._index.execute('PRAGMA synchronous = NORMAL')
+        self._index.execute(
+            'CREATE TABLE IF NOT EXISTS segments (user TEXT NOT NULL, game TEXT NOT NULL, '
+            'first INTEGER NOT NULL, last INTEGER NOT NULL, '
+            'offset INTEGER NOT NULL, length INTEGER NOT NULL)')
+        self._index.execute(
+            'CREATE INDEX IF NOT EXISTS segments_turns ON segments (user, game, last)')
+        self._log = open(self._log_path, 'a+b')
+        fcntl.flock(self._log, fcntl.LOCK_EX)
+        try:
+            return self._recover()
+        finally:
+            fcntl.flock(self._log, fcntl.LOCK_UN)
+
+    def _recover(self):
+        # segments written before a crash and not indexed are indexed, a
+        # partially written segment at the end is cut off
+        end = self._index.execute('SELECT max(offset + length) FROM segments').fetchone()[0] or 0
+        size = os.fstat(self._log.fileno()).st_size
+        records = []
+        while end + self._HEADER.size <= size:
+            length, = self._HEADER.unpack(os.pread(self._log.fileno(), self._HEADER.size, end))
+            offset = end + self._HEADER.size
+            try:
+                segment = self._decode(os.pread(self._log.fileno(), length, offset))
+            except (zlib.error, ValueError, KeyError):
+                break
+            records.append(self._record(segment, offset, length))
+            end = offset + length
+
+        if end < size:
+            error('transcripts: %s bytes of a broken segment cut off', size - end)
+            self._log.truncate(end)
+        with self._index:
+            self._index.executemany('INSERT INTO segments VALUES (?, ?, ?, ?, ?, ?)', records)
+        return len(records)
+
+    @staticmethod
+    def _decode(data):
+        segment = json.loads(zlib.decompress(data).decode('utf-8'))
+        if not segment['turns']:
+            raise ValueError('empty segment')
+        return segment
+
+    @staticmethod
+    def _record(segment, offset, length):
+        turns = segment['turns']
+        return (segment['user'], segment['game'], turns[0]['n'], turns[-1]['n'] + 1,
+                offset, length)
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self._flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                error('transcripts: flush error %s', e)
+
+    def _write(self, games):
+        start = time.monotonic()
+        segments = []
+        for (user, game), turns in games.items():
+            segment = {'user': user, 'game': game, 'turns': turns}
+            segments.append((segment, zlib.compress(json.dumps(segment).encode('utf-8'))))
+
+        # other workers append to the same log, the lock keeps offsets of the
+        # index in line with the file
+        fcntl.flock(self._log, fcntl.LOCK_EX)
+        try:
+            end = os.fstat(self._log.fileno()).st_size
+            records = []
+            for segment, data in segments:
+                self._log.write(self._HEADER.pack(len(data)))
+                self._log.write(data)
+                records.append(self._record(segment, end + self._HEADER.size, len(data)))
+                end += self._HEADER.size + len(data)
+            self._log.flush()
+            with self._index:
+                self._index.executemany('INSERT INTO segments VALUES (?, ?, ?, ?, ?, ?)',
+                                        records)
+        finally:
+            fcntl.flock(self._log, fcntl.LOCK_UN)
+
+        elapsed = time.monotonic() - start
+        TRANSCRIPT_FLUSH_TIME.observe(elapsed)
+        return elapsed, sum(self._HEADER.size + len(data) for _, data in segments)
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._pending:
+                return
+
+            self._flushing, self._pending = self._pending, {}
+            try:
+                elapsed, written = await self._loop.run_in_executor(
+                    self._executor, self._write, self._flushing)
+                self._flushes += 1
+                self._segments += len(self._flushing)
+                self._bytes += written
+                self._flush_time += elapsed
+            except Exception:
+                for key, turns in self._flushing.items():
+                    self._pending[key] = turns + self._pending.get(key, [])
+                raise
+            finally:
+                self._flushing = {}
+
+    def _count(self, key):
+        row = self._index.execute('SELECT max(last) FROM segments WHERE user = ? AND game = ?',
+                                  key).fetchone()
+        return row[0] or 0
+
+    async def count(self, user_id, game):
+        # number of turns recorded for the game
+        key = (str(user_id), game)
+        if key not in self._counts:
+            count = await self._loop.run_in_executor(self._executor, self._count, key)
+            self._counts.setdefault(key, count)
+        return self._counts[key]
+
+    async def append(self, user_id, game, command, paragraphs):
+        key = (str(user_id), game)
+        n = await self.count(user_id, game)
+        self._counts[key] = n + 1
+        self._pending.setdefault(key, []).append(
+            {'n': n, 'time': int(time.time()), 'command': command, 'paragraphs': paragraphs})
+
+    def _read(self, key, start):
+        rows = self._index.execute(
+            'SELECT offset, length FROM segments WHERE user = ? AND game = ? AND last > ? '
+            'ORDER BY last', key + (start,)).fetchall()
+        turns = []
+        for offset, length in rows:
+            turns += self._decode(os.pread(self._log.fileno(), length, offset))['turns']
+        return turns
+
+    async def turns(self, user_id, game, start=0):
+        # turns from number start, written or not
+        key = (str(user_id), game)
+        unwritten = self._flushing.get(key, []) + self._pending.get(key, [])
+        written = await self._loop.run_in_executor(self._executor, self._read, key, start)
+        # turns being flushed may be read from the log as well
+        turns = {turn['n']: turn for turn in written + unwritten if turn['n'] >= start}
+        debug('transcripts: %s turns of %s read', len(turns), key)
+        return [turns[n] for n in sorted(turns)]
+
+    async def last(self, user_id, game, count):
+        total = await self.count(user_id, game)
+        return await self.turns(user_id, game, max(0, total - count))
+
+    def stats(self):
+        return {'pending': sum(len(turns) for turns in self._pending.values()),
+                'flushes': self._flushes,
+                'segments': self._segments,
+                'bytes': self._bytes,
+                'flush_time': self._flush_time}
+
+    def _close_files(self):
+        if self._log:
+            self._log.close()
+        if self._index:
+            self._index.close()
+
+    async def close(self):
+        if self._flush_task:
+            self._flush_task.cancel()
+        if self._open_task:
+            await self._open_task
+            await self.flush()
+        await self._loop.run_in_executor(self._executor, self._close_files)
+        self._executor.shutdown()
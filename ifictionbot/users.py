@@ -0,0 +1,136 @@
+import asyncio
+import concurrent.futures
+import copy
+import json
+import logging
+import sqlite3
+import time
+
+from . import metrics
+
+_logger = logging.getLogger(__name__)
+error = _logger.error
+
+USER_STATE_SAVE_TIME = metrics.Histogram(
+    'ifictionbot_user_state_save_seconds', 'Time to save user state in memory')
+USER_STORE_FLUSH_TIME = metrics.Histogram(
+    'ifictionbot_user_store_flush_seconds', 'Time to write a batch of user states')
+
+
+class UserStore:
+    # states of all users in one sqlite database, saved states are kept in
+    # memory and written in batches
+    _DEFAULT_FLUSH_INTERVAL = 5
+
+    def __init__(self, loop, path, flush_interval=_DEFAULT_FLUSH_INTERVAL):
+        self._loop = loop
+        self._flush_interval = flush_interval
+        self._reader = self._connect(path)
+        self._writer = self._connect(path)
+        self._executor = concurrent.futures.ThreadPoolExecutor(1)
+        self._dirty = {}
+        self._flushing = {}
+        self._flush_task = None
+        self._flush_lock = asyncio.Lock()
+        self._flushes = 0
+        self._flushed_states = 0
+        self._flush_time = 0.0
+
+    @staticmethod
+    def _connect(path):
+        db = sqlite3.connect(path, check_same_thread=False)
+        db.execute('PRAGMA journal_mode = WAL')
+        db.execute('PRAGMA synchronous = NORMAL')
+        db.execute('CREATE TABLE IF NOT EXISTS users (id TEXT PRIMARY KEY, state TEXT NOT NULL)')
+        return db
+
+    def start(self):
+        self._flush_task = self._loop.create_task(self._flush_loop())
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self._flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                error('user store: flush error %s', e)
+
+    def _write(self, states):
+        start = time.monotonic()
+        with self._writer:
+            self._writer.executemany('INSERT OR REPLACE INTO users VALUES (?, ?)', states.items())
+        elapsed = time.monotonic() - start
+        USER_STORE_FLUSH_TIME.observe(elapsed)
+        return elapsed
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._dirty:
+                return
+
+            self._flushing, self._dirty = self._dirty, {}
+            try:
+                self._flush_time += await self._loop.run_in_executor(
+                    self._executor, self._write, self._flushing)
+                self._flushes += 1
+                self._flushed_states += len(self._flushing)
+            except Exception:
+                for key, value in self._flushing.items():
+                    self._dirty.setdefault(key, value)
+                raise
+            finally:
+                self._flushing = {}
+
+    def load(self, user_id):
+        key = str(user_id)
+        data = self._dirty.get(key) or self._flushing.get(key)
+        if data is None:
+            row = self._reader.execute('SELECT state FROM users WHERE id = ?', (key,)).fetchone()
+            data = row[0] if row else None
+        return json.loads(data) if data else {}
+
+    def recent(self, limit):
+        # replaced rows get new rowids, so the last rows are the last saved users
+        rows = self._reader.execute(
+            'SELECT id, state FROM users ORDER BY rowid DESC LIMIT ?', (limit,)).fetchall()
+        return [(user_id, json.loads(state)) for user_id, state in rows]
+
+    def save(self, user_id, state):
+        start = time.monotonic()
+        self._dirty[str(user_id)] = json.dumps(state)
+        USER_STATE_SAVE_TIME.observe(time.monotonic() - start)
+
+    def stats(self):
+        return {'dirty': len(self._dirty),
+                'flushes': self._flushes,
+                'flushed_states': self._flushed_states,
+                'flush_time': self._flush_time}
+
+    async def close(self):
+        if self._flush_task:
+            self._flush_task.cancel()
+        await self.flush()
+        self._executor.shutdown()
+        self._reader.close()
+        self._writer.close()
+
+
+class UserDB:
+    def __init__(self, store, user_id, init_state):
+        self._store = store
+        self._user_id = user_id
+        self._state = store.load(user_id)
+
+        for key, value in init_state.items():
+            if key not in self._state:
+                self._state[key] = copy.deepcopy(value)
+
+    def current_state(self):
+        return self._state
+
+    def save_state(self, state):
+        self._state.update(state)
+        self._store.save(self._user_id, self._state)
+
+    def close(self):
+        pass
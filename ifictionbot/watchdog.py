@@ -0,0 +1,120 @@
+import asyncio
+import collections
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+
+from . import metrics
+
+_logger = logging.getLogger(__name__)
+info, error = _logger.info, _logger.error
+
+LOOP_STALLS = metrics.Counter('ifictionbot_event_loop_stalls_total',
+                              'Event loop stalls longer than the watchdog threshold')
+
+
+def _thread_frame(thread_id):
+    return sys._current_frames().get(thread_id)
+
+
+class StallWatchdog:
+    # the loop marks every tick, a thread reports the loop stack when ticks
+    # stop for longer than threshold, once per stall
+    def __init__(self, loop, threshold):
+        self._loop = loop
+        self._threshold = threshold
+        self._thread_id = None
+        self._tick = time.monotonic()
+        self._reported_tick = None
+        self._stalls = 0
+        self._max_stall = 0.0
+        self._stopped = threading.Event()
+
+    def start(self):
+        # must be called from the loop thread
+        self._thread_id = threading.get_ident()
+        self._loop.create_task(self._ticker())
+        threading.Thread(target=self._watch, name='stall-watchdog', daemon=True).start()
+
+    async def _ticker(self):
+        while not self._stopped.is_set():
+            now = time.monotonic()
+            stall = now - self._tick
+            if self._reported_tick == self._tick:
+                info('watchdog: event loop was stalled for %.3f seconds', stall)
+                self._max_stall = max(self._max_stall, stall)
+            self._tick = now
+            await asyncio.sleep(self._threshold / 4)
+
+    def _watch(self):
+        while not self._stopped.wait(self._threshold / 4):
+            tick = self._tick
+            stall = time.monotonic() - tick
+            if stall < self._threshold or self._reported_tick == tick:
+                continue
+            self._reported_tick = tick
+            self._stalls += 1
+            LOOP_STALLS.inc()
+            frame = _thread_frame(self._thread_id)
+            stack = ''.join(traceback.format_stack(frame)) if frame else 'unknown\n'
+            error('watchdog: event loop stalled for %.3f seconds in\n%s', stall, stack)
+
+    def stats(self):
+        return {'stalls': self._stalls, 'max_stall': self._max_stall}
+
+    def close(self):
+        self._stopped.set()
+
+
+class SamplingProfiler:
+    # samples the stack of one thread and writes collapsed stacks, the input
+    # format of flamegraph.pl and speedscope
+    _DEFAULT_INTERVAL = 0.005
+
+    def __init__(self, interval=_DEFAULT_INTERVAL):
+        self._interval = interval
+        self._thread_id = None
+        self._samples = collections.Counter()
+        self._stopped = None
+        self._thread = None
+
+    def is_running(self):
+        return self._thread is not None
+
+    def start(self, thread_id=None):
+        self._thread_id = thread_id or threading.get_ident()
+        self._samples = collections.Counter()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._sample, name='profiler', daemon=True)
+        self._thread.start()
+        info('profiler: started')
+
+    def stop(self, path):
+        self._stopped.set()
+        self._thread.join()
+        self._thread = None
+        with open(path, 'w') as f:
+            for stack, count in self._samples.most_common():
+                f.write('{} {}\n'.format(stack, count))
+        info('profiler: %s samples written to %s', sum(self._samples.values()), path)
+
+    def toggle(self, path_dir):
+        if self.is_running():
+            self.stop(os.path.join(path_dir, 'profile.{}.{}.folded'.format(
+                os.getpid(), time.strftime('%Y%m%d-%H%M%S'))))
+        else:
+            self.start()
+
+    def _sample(self):
+        while not self._stopped.wait(self._interval):
+            frame = _thread_frame(self._thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('{}:{}'.format(os.path.basename(code.co_filename), code.co_name))
+                frame = frame.f_back
+            if stack:
+                self._samples[';'.join(reversed(stack))] += 1
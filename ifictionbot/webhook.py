@@ -0,0 +1,108 @@
+import asyncio
+import hmac
+import json
+import logging
+
+_logger = logging.getLogger(__name__)
+info, error = _logger.info, _logger.error
+
+SECRET_HEADER = 'x-telegram-bot-api-secret-token'
+
+_REASONS = {200: 'OK', 400: 'Bad Request', 403: 'Forbidden', 404: 'Not Found',
+            405: 'Method Not Allowed', 413: 'Payload Too Large'}
+
+
+class WebhookServer:
+    # minimal HTTP/1.1 endpoint receiving telegram updates pushed with setWebhook
+    _MAX_BODY = 1024 * 1024
+
+    def __init__(self, handler, path, secret):
+        self._handler = handler
+        self._path = path
+        self._secret = secret.encode('utf-8')
+        self._server = None
+        self._requests = 0
+        self._updates = 0
+        self._rejected = 0
+
+    async def start(self, host, port):
+        self._server = await asyncio.start_server(self._serve, host, port)
+        info('webhook: listening on %s:%s%s', host, port, self._path)
+
+    def close(self):
+        if self._server:
+            self._server.close()
+
+    async def _serve(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+
+                method, target, version = request_line.decode('latin-1').split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                length = int(headers.get('content-length', 0))
+                if length > self._MAX_BODY:
+                    self._respond(writer, 413, False)
+                    break
+
+                body = await reader.readexactly(length)
+                keep_alive = (version == 'HTTP/1.1' and
+                              headers.get('connection', '').lower() != 'close')
+                self._respond(writer, self._handle(method, target, headers, body), keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError) as e:
+            error('webhook: bad request %s', e)
+        finally:
+            writer.close()
+
+    def _handle(self, method, target, headers, body):
+        self._requests += 1
+        if target.split('?', 1)[0] != self._path:
+            status = 404
+        elif method != 'POST':
+            status = 405
+        elif not hmac.compare_digest(headers.get(SECRET_HEADER, '').encode('utf-8'),
+                                     self._secret):
+            status = 403
+        else:
+            try:
+                updates = json.loads(body.decode('utf-8'))
+            except ValueError:
+                updates = None
+
+            if isinstance(updates, dict):
+                updates = [updates]
+            if not isinstance(updates, list):
+                status = 400
+            else:
+                for update in updates:
+                    self._handler(update)
+                self._updates += len(updates)
+                return 200
+
+        self._rejected += 1
+        return status
+
+    @staticmethod
+    def _respond(writer, status, keep_alive):
+        writer.write('HTTP/1.1 {} {}\r\nContent-Length: 0\r\nConnection: {}\r\n\r\n'.format(
+            status, _REASONS[status], 'keep-alive' if keep_alive else 'close').encode('latin-1'))
+
+    def stats(self):
+        return {'requests': self._requests, 'updates': self._updates, 'rejected': self._rejected}
+
+
+def parse_address(address):
+    host, _, port = address.rpartition(':')
+    return host or '0.0.0.0', int(port)
@@ -0,0 +1,77 @@
+import concurrent.futures
+import logging
+import os
+import time
+
+_logger = logging.getLogger(__name__)
+info, error = _logger.info, _logger.error
+
+
+class Workspaces:
+    # user game directories with links to game files, prepared directories
+    # are remembered so game starts don't touch the filesystem again
+    def __init__(self, loop, data_path):
+        self._loop = loop
+        self._games_path = os.path.abspath(data_path + '/games')
+        self._users_path = os.path.abspath(data_path + '/users')
+        self._prepared = set()
+        self._executor = concurrent.futures.ThreadPoolExecutor(1)
+        self._hits = 0
+        self._misses = 0
+
+    def game_path(self, user_id, game):
+        return '{}/{}/{}'.format(self._users_path, user_id, game)
+
+    def _prepare(self, user_id, game):
+        path = self.game_path(user_id, game)
+        os.makedirs(path, exist_ok=True)
+        source = '{}/{}.gam'.format(self._games_path, game)
+        link = '{}/{}.gam'.format(path, game)
+        try:
+            if os.readlink(link) == source:
+                return path
+        except OSError:
+            pass
+        tmp_link = '{}.{}.tmp'.format(link, os.getpid())
+        try:
+            os.unlink(tmp_link)  # left by a crashed process with the same pid
+        except FileNotFoundError:
+            pass
+        os.symlink(source, tmp_link)
+        os.replace(tmp_link, link)
+        return path
+
+    async def game_dir(self, user_id, game):
+        key = (str(user_id), game)
+        if key in self._prepared:
+            self._hits += 1
+            return self.game_path(user_id, game)
+
+        self._misses += 1
+        path = await self._loop.run_in_executor(self._executor, self._prepare, user_id, game)
+        self._prepared.add(key)
+        return path
+
+    def _prepare_all(self, keys):
+        prepared = []
+        for user_id, game in keys:
+            try:
+                self._prepare(user_id, game)
+                prepared.append((user_id, game))
+            except OSError as e:
+                error('workspaces: %s %s prepare error %s', user_id, game, e)
+        return prepared
+
+    async def prepare(self, keys):
+        keys = [(str(user_id), game) for user_id, game in keys]
+        keys = [key for key in keys if key not in self._prepared]
+        start = time.monotonic()
+        prepared = await self._loop.run_in_executor(self._executor, self._prepare_all, keys)
+        self._prepared.update(prepared)
+        info('workspaces: %s prepared in %.3f seconds', len(prepared), time.monotonic() - start)
+
+    def stats(self):
+        return {'prepared': len(self._prepared), 'hits': self._hits, 'misses': self._misses}
+
+    def close(self):
+        self._executor.shutdown()
@@ -0,0 +1,41 @@
+# Golden screens for OutputParser, each parsed whole and split at every
+# byte, also inside UTF-8 sequences
+import pytest
+
+from ifictionbot import session
+
+SCREENS = [
+    # split UTF-8 sequence
+    ('Кубок on the table\ncafé — here\n\n'.encode('utf-8'),
+     ['Кубок on the table café — here']),
+    # '>'-prefixed lines
+    (b'>look\nYou see a lamp\n>\n> Indented\nnorth door\n\n>',
+     ['look\nYou see a lamp', ' Indented north door']),
+    # last line without '\n'
+    (b'First\n\nSecond line\nand more',
+     ['First', 'Second line and more']),
+]
+
+
+def parse(parts):
+    parser = session.OutputParser()
+    paragraphs = []
+    for part in parts:
+        paragraphs += parser.feed(part)
+    return paragraphs + parser.finish()
+
+
+@pytest.mark.parametrize('screen, expected', SCREENS)
+def test_whole_screen(screen, expected):
+    assert parse([screen]) == expected
+
+
+@pytest.mark.parametrize('screen, expected', SCREENS)
+def test_screen_split_at_every_byte(screen, expected):
+    for cut in range(len(screen) + 1):
+        assert parse([screen[:cut], screen[cut:]]) == expected, cut
+
+
+def test_byte_by_byte():
+    screen, expected = SCREENS[0]
+    assert parse([screen[i:i + 1] for i in range(len(screen))]) == expected